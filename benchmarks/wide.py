@@ -0,0 +1,68 @@
+"""Benchmark the conversion of wide dta files (thousands of variables).
+
+Synthetic files with a mix of double, byte, int and string variables (some
+with Unicode) and 80-character variable labels are written to a temporary
+directory, then converted to each target version with `convert_dta`.
+
+Usage::
+
+    make bench  # 10,000 and 30,000 variables
+    PYTHONPATH=. python benchmarks/wide.py 5000 --nobs 1000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from rbStata.helpers import convert_dta, object_strings
+
+
+def make_wide(filename: str, nvar: int, nobs: int, seed: int = 0) -> None:
+    """Write a synthetic dta file with `nvar` variables and `nobs` rows."""
+    rng = np.random.default_rng(seed)
+    words = np.array(["alpha", "beta", "Zürich", "", "São Paulo"], dtype=object)
+    columns = {}
+    for i in range(nvar):
+        kind = i % 4
+        if kind == 0:
+            columns[f"d{i}"] = rng.random(nobs)
+        elif kind == 1:
+            columns[f"b{i}"] = rng.integers(0, 100, nobs).astype(np.int8)
+        elif kind == 2:
+            columns[f"i{i}"] = rng.integers(0, 30000, nobs).astype(np.int16)
+        else:
+            columns[f"s{i}"] = words[rng.integers(0, len(words), nobs)]
+    df = object_strings(pd.DataFrame(columns))
+    labels = {col: f"Libellé {col} ".ljust(80, "x") for col in df.columns}
+    df.to_stata(
+        filename, write_index=False, version=118, variable_labels=labels
+    )
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("nvar", type=int, nargs="*", default=[10_000, 30_000])
+    parser.add_argument("--nobs", type=int, default=200)
+    parser.add_argument("--targets", type=int, nargs="+", default=[17, 13, 12])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'variables':>10} {'target':>7} {'seconds':>9} {'MB out':>8}")
+        for nvar in args.nvar:
+            source = os.path.join(tmp, f"wide{nvar}.dta")
+            make_wide(source, nvar, args.nobs)
+            for target in args.targets:
+                output = os.path.join(tmp, f"wide{nvar}-v{target}.dta")
+                start = time.perf_counter()
+                convert_dta(source, output, target)
+                seconds = time.perf_counter() - start
+                size = os.path.getsize(output) / 1e6
+                print(f"{nvar:>10} {target:>7} {seconds:>9.2f} {size:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,634 @@
+"""Helpers for batch conversion."""
+import hashlib
+import json
+import os
+import queue
+import shutil
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from click import ClickException
+
+from rbStata.cache import file_digest
+from rbStata.helpers import is_dta_file
+
+LOCK_SUFFIX = ".rbstata-lock"
+
+# Ways of materialising the output of a duplicate input, see `materialize`
+DEDUP_METHODS = ("reflink", "hardlink", "copy")
+
+# ioctl request to share extents between files (Linux, e.g. Btrfs and XFS)
+FICLONE = 0x40049409
+
+# Files claimed ahead of their conversion by `prefetch_files`, so that other
+# processes sharing the work (--work-steal) can still claim the rest
+CLAIM_AHEAD = 2
+
+# Lock files of the claims held by this process, with their tokens
+_claims: Dict[str, str] = {}
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """Parse a shard specification of the form ``i/N``.
+
+    Shards are numbered from 0, so ``0/4`` to ``3/4`` cover a set of files
+    split four ways.
+
+    Parameters
+    ----------
+    shard: str
+        Shard specification, e.g. ``"1/4"``.
+
+    Examples
+    --------
+    >>> parse_shard("1/4")
+    (1, 4)
+
+    Returns
+    -------
+    Tuple
+        Shard index and shard count.
+
+    Raises
+    ------
+    ClickException
+        If the specification is malformed or the index is out of range.
+    """
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ClickException(f"{shard} is not a valid shard (expected i/N).")
+    if (count < 1) or not (0 <= index < count):
+        raise ClickException(
+            f"{shard} is not a valid shard (expected 0 <= i < N)."
+        )
+    return index, count
+
+
+def shard_of(filename: str, count: int) -> int:
+    """Get the shard a file belongs to using a stable hash of its path.
+
+    The hash does not depend on the Python process (unlike ``hash``), so
+    every host that sees the same relative path assigns it to the same shard.
+
+    Parameters
+    ----------
+    filename: str
+        Path of the file.
+    count: int
+        Number of shards.
+
+    Examples
+    --------
+    >>> shard_of("auto.dta", 1)
+    0
+
+    Returns
+    -------
+    Int
+        Shard index in ``range(count)``.
+    """
+    key = Path(os.path.normpath(filename)).as_posix().encode("utf-8")
+    digest = hashlib.md5(key).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+def shard_files(files: Sequence[str], index: int, count: int) -> List[str]:
+    """Keep only the files that belong to shard ``index`` of ``count``.
+
+    Parameters
+    ----------
+    files: list-like
+        List of dta files.
+    index: int
+        Shard index (0-based).
+    count: int
+        Number of shards.
+
+    Examples
+    --------
+    >>> shard_files(["auto.dta", "census.dta"], 0, 1)
+    ['auto.dta', 'census.dta']
+
+    Returns
+    -------
+    List
+        Files assigned to the shard, in their original order.
+    """
+    return [f for f in files if shard_of(f, count) == index]
+
+
+def _read_lock(lock: str) -> dict:
+    """Read the contents of a lock file (empty dict if unreadable)."""
+    try:
+        with open(lock, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _lock_is_stale(lock: str, lease: float, job: str = "") -> bool:
+    """Check if a lock is expired, or is the finished lock of another job."""
+    try:
+        age = time.time() - os.stat(lock).st_mtime
+    except FileNotFoundError:
+        return True
+    info = _read_lock(lock)
+    if info.get("state") == "done":
+        return info.get("job", "") != job
+    return age > lease
+
+
+def _break_lock(lock: str, token: str, lease: float, job: str = "") -> None:
+    """Remove a stale lock, unless it changed since its token was read.
+
+    Only one process at a time can break a lock: it must first create
+    ``<lock>.break`` with ``O_EXCL``. The lock is checked again under it, so
+    that a lock renewed or replaced in the meantime is left alone.
+    """
+    breaker = f"{lock}.break"
+    try:
+        fd = os.open(breaker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        # Another process is breaking the lock, or died while doing so
+        try:
+            if time.time() - os.stat(breaker).st_mtime > lease:
+                os.remove(breaker)
+        except FileNotFoundError:
+            pass
+        return
+    os.close(fd)
+    try:
+        if (_read_lock(lock).get("token", "") == token) and _lock_is_stale(
+            lock, lease, job
+        ):
+            os.remove(lock)
+    except FileNotFoundError:
+        pass
+    finally:
+        os.remove(breaker)
+
+
+def claim_file(filename: str, lease: float = 600.0, job: str = "") -> bool:
+    """Atomically claim a file for conversion using a lock file.
+
+    The lock file (``<filename>.rbstata-lock``) is created with
+    ``O_CREAT | O_EXCL``, so only one process can hold it, even across hosts
+    sharing the same filesystem. Locks of finished conversions are kept so
+    that files are never converted twice by the same job. Unfinished locks
+    older than ``lease`` seconds are assumed to belong to a dead process and
+    are taken over, by one process at a time (see `_break_lock`). Claims are
+    kept alive during long conversions by `heartbeat`.
+
+    Parameters
+    ----------
+    filename: str
+        File to claim (e.g., the output of the conversion).
+    lease: float
+        Seconds after which an unfinished claim expires. Default is 600.
+    job: str
+        Description of the work (e.g., the target version). A finished lock
+        of another job is taken over, so that the file is converted again.
+
+    Returns
+    -------
+    Bool
+        True if this process now owns the file.
+    """
+    lock = f"{filename}{LOCK_SUFFIX}"
+    # Create the lock, else break it if stale and retry (a break file left by
+    # a dead process takes one more round)
+    for _ in range(3):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            token = _read_lock(lock).get("token", "")
+            if not _lock_is_stale(lock, lease, job):
+                return False
+            _break_lock(lock, token, lease, job)
+            continue
+        token = uuid.uuid4().hex
+        info = dict(
+            token=token,
+            host=socket.gethostname(),
+            pid=os.getpid(),
+            job=job,
+            state="running",
+            time=time.time(),
+        )
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(info, f)
+        _claims[lock] = token
+        return True
+    return False
+
+
+def release_file(filename: str, done: bool = True) -> None:
+    """Release a claim on a file.
+
+    Nothing is done if the claim expired and was taken over by another
+    process, whose lock is left alone.
+
+    Parameters
+    ----------
+    filename: str
+        File previously claimed with `claim_file`.
+    done: bool
+        If True, mark the conversion as finished so that no other process
+        converts the file again. If False (e.g., the conversion failed),
+        remove the lock so that another process can retry. Default is True.
+
+    Returns
+    -------
+    None
+    """
+    lock = f"{filename}{LOCK_SUFFIX}"
+    token = _claims.pop(lock, None)
+    info = _read_lock(lock)
+    if (token is None) or (info.get("token") != token):
+        return
+    if not done:
+        try:
+            os.remove(lock)
+        except FileNotFoundError:
+            pass
+        return
+    info.update(state="done", time=time.time())
+    with open(lock, "w", encoding="utf-8") as f:
+        json.dump(info, f)
+
+
+def renew_file(filename: str) -> bool:
+    """Restart the lease of a claim held by this process.
+
+    Files claimed ahead of their conversion (see `prefetch_files`) may wait
+    longer than the lease, so their claims are renewed when their conversion
+    starts.
+
+    Parameters
+    ----------
+    filename: str
+        File previously claimed with `claim_file`.
+
+    Returns
+    -------
+    Bool
+        True if this process still holds the claim, False if it expired and
+        was taken over by another process.
+    """
+    return _renew_lock(f"{filename}{LOCK_SUFFIX}")
+
+
+def _renew_lock(lock: str) -> bool:
+    info = _read_lock(lock)
+    token = _claims.get(lock)
+    if (token is None) or (info.get("token"), info.get("state")) != (
+        token,
+        "running",
+    ):
+        return False
+    try:
+        os.utime(lock)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+@contextmanager
+def heartbeat(lease: float) -> Iterator[None]:
+    """Renew the claims held by this process while the context is active.
+
+    Claims are renewed every third of `lease` from a background thread, so
+    that conversions longer than the lease are not taken over by another
+    process.
+
+    Parameters
+    ----------
+    lease: float
+        Seconds after which an unfinished claim expires.
+
+    Returns
+    -------
+    Iterator
+        Context manager.
+    """
+    stop = threading.Event()
+
+    def beat() -> None:
+        while not stop.wait(lease / 3):
+            for lock in list(_claims):
+                _renew_lock(lock)
+
+    thread = threading.Thread(
+        target=beat, name="rbstata-heartbeat", daemon=True
+    )
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def find_duplicates(files: Sequence[str]) -> Dict[str, List[str]]:
+    """Group files with identical contents.
+
+    Files are first grouped by size, and only files that share a size are
+    hashed. Files that do not exist are ignored.
+
+    Parameters
+    ----------
+    files: list-like
+        List of dta files.
+
+    Returns
+    -------
+    Dict
+        Mapping from the first file of each group of identical files (the
+        representative) to the other files in the group. Files without
+        duplicates are left out.
+    """
+    by_size: Dict[int, List[str]] = {}
+    for file in dict.fromkeys(files):
+        if os.path.isfile(file):
+            by_size.setdefault(os.path.getsize(file), []).append(file)
+
+    duplicates = {}
+    for same_size in by_size.values():
+        if len(same_size) < 2:
+            continue
+        by_digest: Dict[str, List[str]] = {}
+        for file in same_size:
+            by_digest.setdefault(file_digest(file), []).append(file)
+        for group in by_digest.values():
+            if len(group) > 1:
+                duplicates[group[0]] = group[1:]
+    return duplicates
+
+
+def _reflink(src: str, dst: str) -> None:
+    """Clone a file with copy-on-write (raises OSError if unsupported)."""
+    import fcntl
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def materialize(src: str, dst: str, method: str = "reflink") -> str:
+    """Make ``dst`` a copy of ``src`` without converting it again.
+
+    Reflinks and hardlinks fall back to a plain copy when the filesystem
+    (or platform) does not support them. ``dst`` is replaced atomically.
+
+    Parameters
+    ----------
+    src: str
+        Converted output of the representative file.
+    dst: str
+        Output path of the duplicate.
+    method: str
+        One of "reflink", "hardlink" or "copy". Default is "reflink".
+
+    Returns
+    -------
+    Str
+        Method that was actually used.
+    """
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return method
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    try:
+        if method == "reflink":
+            try:
+                _reflink(src, tmp)
+            except (ImportError, OSError):
+                method = "copy"
+        elif method == "hardlink":
+            try:
+                os.link(src, tmp)
+            except OSError:
+                method = "copy"
+        if method == "copy":
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return method
+
+
+class ByteBudget:
+    """Bound the number of bytes held in flight between pipeline stages.
+
+    Parameters
+    ----------
+    limit: int
+        Maximum number of bytes that can be held at once. A single request
+        larger than the limit is capped so that it can still go through
+        (alone).
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = max(int(limit), 1)
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes: int) -> int:
+        """Block until ``nbytes`` fit in the budget and take them.
+
+        Returns
+        -------
+        Int
+            Number of bytes taken (to be passed to `release`).
+        """
+        nbytes = min(nbytes, self.limit)
+        with self._cond:
+            self._cond.wait_for(lambda: self.used + nbytes <= self.limit)
+            self.used += nbytes
+        return nbytes
+
+    def release(self, nbytes: int) -> None:
+        """Give back bytes taken with `acquire`."""
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+
+def prefetch_files(
+    files: Sequence[str],
+    budget: ByteBudget,
+    claim: Optional[Callable[[str], bool]] = None,
+    release: Optional[Callable[[str], None]] = None,
+    claim_ahead: int = CLAIM_AHEAD,
+) -> Generator[Tuple[str, Optional[bytes]], None, None]:
+    """Read files ahead of their conversion in a background thread.
+
+    Closing the iterator early (e.g., after a failed conversion) stops the
+    background thread and releases the files it claimed but did not yield.
+
+    Parameters
+    ----------
+    files: list-like
+        List of dta files.
+    budget: ByteBudget
+        Budget bounding the bytes read ahead. The bytes of a file are given
+        back when the next file is requested.
+    claim: callable
+        (Optional) Function called on each valid dta file before reading it
+        (e.g., `claim_file`). Files for which it returns False are not read.
+    release: callable
+        (Optional) Function called on each claimed file that was not yielded
+        when the iterator is closed (e.g., ``release_file(file, done=False)``).
+    claim_ahead: int
+        Maximum number of files claimed but not yielded yet, whatever the
+        budget. Default is `CLAIM_AHEAD`.
+
+    Returns
+    -------
+    Iterator
+        Pairs of file and contents, in the order of `files`. The contents are
+        None for invalid and unclaimed files.
+    """
+    prefetched: queue.Queue = queue.Queue()
+    stop = threading.Event()
+    # Claimed files not yielded yet, guarded by `pending_changed`
+    pending: set = set()
+    pending_changed = threading.Condition()
+
+    def read() -> None:
+        for file in files:
+            try:
+                try:
+                    valid = is_dta_file(file)
+                except ClickException:
+                    valid = False
+                if valid and (claim is not None):
+                    with pending_changed:
+                        pending_changed.wait_for(
+                            lambda: stop.is_set()
+                            or (len(pending) < claim_ahead)
+                        )
+                        if stop.is_set():
+                            return
+                        valid = claim(file)
+                        if valid:
+                            pending.add(file)
+                if not valid:
+                    prefetched.put((file, None, 0))
+                    continue
+                nbytes = budget.acquire(os.path.getsize(file))
+                with open(file, "rb") as f:
+                    data = f.read()
+                prefetched.put((file, data, nbytes))
+            except BaseException as e:
+                prefetched.put((file, e, 0))
+                return
+
+    reader = threading.Thread(target=read, name="rbstata-reader", daemon=True)
+    reader.start()
+    try:
+        for _ in files:
+            file, data, nbytes = prefetched.get()
+            if isinstance(data, BaseException):
+                raise data
+            with pending_changed:
+                pending.discard(file)
+                pending_changed.notify_all()
+            yield file, data
+            budget.release(nbytes)
+    finally:
+        with pending_changed:
+            stop.set()
+            pending_changed.notify_all()
+            unprocessed = sorted(pending)
+        if release is not None:
+            for file in unprocessed:
+                release(file)
+
+
+class BackgroundWriter:
+    """Write converted files in a background thread.
+
+    Parameters
+    ----------
+    budget: ByteBudget
+        Budget bounding the bytes waiting to be written. `submit` blocks while
+        the budget is used up.
+    """
+
+    def __init__(self, budget: ByteBudget) -> None:
+        self.budget = budget
+        self.errors: List[BaseException] = []
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._write, name="rbstata-writer", daemon=True
+        )
+        self._thread.start()
+
+    def _write(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, data, nbytes, callback = item
+            try:
+                if not self.errors:
+                    with open(path, "wb") as f:
+                        f.write(data)
+                    if callback is not None:
+                        callback()
+            except BaseException as e:
+                self.errors.append(e)
+            finally:
+                self.budget.release(nbytes)
+
+    def _raise(self) -> None:
+        if self.errors:
+            raise self.errors[0]
+
+    def submit(
+        self,
+        path: str,
+        data: bytes,
+        callback: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """Queue ``data`` to be written to ``path``.
+
+        Parameters
+        ----------
+        path: str
+            Output file.
+        data: bytes
+            Contents of the output file.
+        callback: callable
+            (Optional) Function called (in the writer thread) once the file
+            is written, e.g. to release a claim on its input.
+
+        Raises
+        ------
+        Exception
+            Any error raised by a previous write.
+        """
+        self._raise()
+        nbytes = self.budget.acquire(len(data))
+        self._queue.put((path, data, nbytes, callback))
+
+    def close(self) -> None:
+        """Wait for pending writes and raise the first error, if any."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise()
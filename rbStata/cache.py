@@ -0,0 +1,249 @@
+"""Persistent cache of parsed dta files in Arrow IPC (Feather) format.
+
+The cache needs pyarrow, which is optional (``pip install rbstata[cache]``).
+"""
+import hashlib
+import json
+import os
+import uuid
+from typing import IO, Optional, Tuple, Union
+
+import pandas as pd
+from click import ClickException
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:  # pragma: no cover
+    pa = None
+
+# Bump when the layout of cached files changes, so that old files are ignored
+CACHE_FORMAT = 1
+
+CACHE_SUFFIX = ".arrow"
+
+# Default bound on the total size of the cache, in megabytes
+CACHE_SIZE = 10240
+
+
+def file_digest(input: Union[str, IO[bytes]], chunk_size: int = 1 << 20) -> str:
+    """Get the BLAKE2b hash of a file's contents.
+
+    Parameters
+    ----------
+    input: str or file-like
+        File to hash. A file-like object is hashed from its start and its
+        position is restored.
+    chunk_size: int
+        Bytes read at a time. Default is 1 MiB.
+
+    Returns
+    -------
+    Str
+        Hex digest of the contents.
+    """
+    digest = hashlib.blake2b()
+    if isinstance(input, str):
+        with open(input, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    position = input.tell()
+    input.seek(0)
+    for chunk in iter(lambda: input.read(chunk_size), b""):
+        digest.update(chunk)
+    input.seek(position)
+    return digest.hexdigest()
+
+
+def require_pyarrow() -> None:
+    """Raise a ClickException if pyarrow is not installed.
+
+    Returns
+    -------
+    None
+    """
+    if pa is None:
+        raise ClickException(
+            "The cache needs pyarrow. Install it with: pip install rbstata[cache]"
+        )
+
+
+def cache_path(cache_dir: str, key: str) -> str:
+    """Get the path of a cached file.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Cache directory.
+    key: str
+        Content hash of the source dta file (see `file_digest`).
+
+    Examples
+    --------
+    >>> cache_path("cache", "ab12")
+    'cache/ab12.arrow'
+
+    Returns
+    -------
+    Str
+        Path.
+    """
+    return os.path.join(cache_dir, f"{key}{CACHE_SUFFIX}")
+
+
+def load_cached(
+    cache_dir: str, key: str
+) -> Optional[Tuple[pd.DataFrame, dict]]:
+    """Load the parsed data and metadata of a dta file from the cache.
+
+    The cached file is memory-mapped rather than read, and marked as the most
+    recently used. Numeric columns without missing values are views of the
+    mapped file; other columns (e.g., strings and categoricals) are copied.
+    Unreadable files are removed.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Cache directory.
+    key: str
+        Content hash of the source dta file (see `file_digest`).
+
+    Returns
+    -------
+    Tuple
+        Data and metadata (``data_label``, ``variable_labels``, ``typlist``
+        and ``value_labels``), or None if the file is not cached.
+    """
+    require_pyarrow()
+    path = cache_path(cache_dir, key)
+    if not os.path.isfile(path):
+        return None
+    try:
+        table = feather.read_table(path, memory_map=True)
+        meta = json.loads(table.schema.metadata[b"rbstata"])
+    except (pa.ArrowException, OSError, KeyError, ValueError):
+        os.remove(path)
+        return None
+    if meta.get("format") != CACHE_FORMAT:
+        return None
+    meta["value_labels"] = {
+        name: {int(code): label for code, label in labels.items()}
+        for name, labels in meta["value_labels"].items()
+    }
+    # Without split_blocks, columns would be copied into consolidated blocks
+    df = table.to_pandas(split_blocks=True)
+    os.utime(path)
+    return df, meta
+
+
+def store_cached(
+    cache_dir: str,
+    key: str,
+    df: pd.DataFrame,
+    meta: dict,
+    max_size: int = CACHE_SIZE * 2**20,
+) -> bool:
+    """Store the parsed data and metadata of a dta file in the cache.
+
+    The data are written uncompressed and in one record batch so that they
+    can be memory-mapped without copies, and the least recently used files
+    are then evicted to keep the cache within `max_size`. Data larger than
+    `max_size` on their own are not stored, rather than evicting every other
+    file.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Cache directory, created if needed.
+    key: str
+        Content hash of the source dta file (see `file_digest`).
+    df: pd.DataFrame
+        Data.
+    meta: dict
+        JSON-serializable metadata (see `load_cached`).
+    max_size: int
+        Bound on the total size of the cache in bytes. Default is
+        `CACHE_SIZE` megabytes.
+
+    Returns
+    -------
+    Bool
+        True if the data were stored, False if Arrow cannot hold them or if
+        they do not fit in `max_size`.
+    """
+    require_pyarrow()
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except pa.ArrowException:
+        return False
+    value_labels = {
+        name: {int(code): label for code, label in labels.items()}
+        for name, labels in meta.get("value_labels", {}).items()
+    }
+    meta = dict(meta, value_labels=value_labels, format=CACHE_FORMAT)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"rbstata"] = json.dumps(meta)
+    table = table.replace_schema_metadata(metadata)
+    if table.nbytes > max_size:
+        return False
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir, key)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        # One record batch, as columns split into batches are concatenated
+        # (copied) when loaded
+        feather.write_feather(
+            table,
+            tmp,
+            compression="uncompressed",
+            chunksize=max(table.num_rows, 1),
+        )
+        if os.path.getsize(tmp) > max_size:
+            return False
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    evict_cached(cache_dir, max_size)
+    return True
+
+
+def evict_cached(cache_dir: str, max_size: int) -> int:
+    """Remove the least recently used files until the cache fits `max_size`.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Cache directory.
+    max_size: int
+        Bound on the total size of the cache in bytes.
+
+    Returns
+    -------
+    Int
+        Number of files removed.
+    """
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(CACHE_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    return removed
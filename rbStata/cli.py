@@ -1,11 +1,33 @@
 """Main user-facing function."""
+import io
+import time
 import warnings
-from typing import Optional, Sequence
+from contextlib import ExitStack
+from functools import partial
+from typing import IO, Any, List, Optional, Sequence, Union
 
 import click
 from click import ClickException
 
+from rbStata.batch import (
+    DEDUP_METHODS,
+    BackgroundWriter,
+    ByteBudget,
+    claim_file,
+    find_duplicates,
+    heartbeat,
+    materialize,
+    parse_shard,
+    prefetch_files,
+    release_file,
+    renew_file,
+    shard_files,
+)
+from rbStata.cache import CACHE_SIZE, require_pyarrow
+from rbStata.client import socket_path
+from rbStata.engines import ENGINES, select_engine
 from rbStata.helpers import (
+    STATA_VERSIONS,
     convert_dta,
     get_output_name,
     glob_dta_files,
@@ -13,6 +35,14 @@ from rbStata.helpers import (
     normalize_dta_filename,
     normalize_filename,
 )
+from rbStata.metrics import (
+    LOG_FORMATS,
+    conversion_event,
+    describe_source,
+    echo_event,
+    update_textfile,
+)
+from rbStata.server import serve as serve_forever
 
 warnings.simplefilter(action="ignore", category=Warning)
 
@@ -23,6 +53,174 @@ CONTEXT_SETTINGS = dict(
 )
 
 
+def echo_report(file: str, report: dict, compress: bool = False) -> None:
+    """Print the bytes saved by compression and the truncated strings of a file.
+
+    Parameters
+    ----------
+    file: str
+        Input (source) dta file.
+    report: dict
+        Conversion report returned by `convert_dta`.
+    compress: bool
+        If True, print the bytes saved by compression. Default is False.
+
+    Returns
+    -------
+    None
+    """
+    if compress:
+        click.secho("+ Compressed: ", fg="green", bold=True, nl=False)
+        click.echo(f"{file} ({report['bytes_saved']:,} bytes saved).")
+    if report["truncated"]:
+        counts = ", ".join(
+            f"{col} ({n:,} values)" for col, n in report["truncated"].items()
+        )
+        click.secho(
+            "+ Truncated to 244 bytes: ", fg="yellow", bold=True, nl=False
+        )
+        click.echo(f"{file}: {counts}.")
+
+
+def pick_engine(
+    file: str,
+    source: Union[str, IO[bytes]],
+    target_version: int,
+    engine: str,
+    memory_limit: Optional[int] = None,
+    transform: bool = False,
+    verbose: bool = False,
+) -> str:
+    """Resolve the "auto" engine for a file and log the decision.
+
+    Parameters
+    ----------
+    file: str
+        Input (source) dta file.
+    source: str or file-like
+        Input (source) dta file, or its contents.
+    target_version: int
+        Stata version to convert to.
+    engine: str
+        Engine requested with --engine.
+    memory_limit: int
+        (Optional) Memory budget in megabytes. If None, use the available
+        memory.
+    transform: bool
+        If True, the data must be transformed, so that the file cannot be
+        copied as is. Default is False.
+    verbose: bool
+        If True, print the engine picked and the memory estimates. Default is
+        False. They are printed anyway, with a warning, if no engine fits the
+        budget.
+
+    Returns
+    -------
+    Str
+        Engine to pass to `convert_dta`.
+    """
+    if engine != "auto":
+        return engine
+    engine, decision = select_engine(
+        source,
+        STATA_VERSIONS[target_version],
+        memory_limit=None if memory_limit is None else memory_limit * 2**20,
+        transform=transform,
+    )
+    if verbose or not decision["fits"]:
+        estimates = ", ".join(
+            f"{name} {nbytes / 2**20:,.1f} MB"
+            for name, nbytes in decision["estimates"].items()
+        )
+        budget = decision["budget"]
+        budget = "unknown" if budget is None else f"{budget / 2**20:,.1f} MB"
+        fits = "" if decision["fits"] else "; no engine fits"
+        click.echo(
+            f"+ Engine: {file}: {engine} "
+            f"(estimated peak: {estimates or 'unknown'}; budget: {budget}"
+            f"{fits})."
+        )
+    if not decision["fits"]:
+        click.echo(
+            f"+ Warning: {file} may not fit in memory with any engine; "
+            "raise --memory-limit or free memory if the conversion fails."
+        )
+    return engine
+
+
+def convert_logged(
+    file: str,
+    source: Union[str, IO[bytes]],
+    out: Union[str, IO[bytes]],
+    target_version: int,
+    engine: str,
+    events: List[dict],
+    log_format: str = "text",
+    output_path: Optional[str] = None,
+    **options: Any,
+) -> dict:
+    """Convert a file with `convert_dta` and record a conversion event.
+
+    The event (see `conversion_event`) is recorded whether the conversion
+    succeeds or raises. The source is described before it is converted, as
+    the output may overwrite it.
+
+    Parameters
+    ----------
+    file: str
+        Input (source) dta file.
+    source: str or file-like
+        Input (source) dta file, or its contents.
+    out: str or file-like
+        Output dta file, or a buffer for its contents.
+    target_version: int
+        Stata version to convert to.
+    engine: str
+        Engine to pass to `convert_dta`.
+    events: list
+        Events of the run, to which the event is appended.
+    log_format: str
+        If "json", also print the event as a line of JSON. Default is "text".
+    output_path: str
+        (Optional) Path the output is written to, if `out` is a buffer.
+    options:
+        Other arguments of `convert_dta` (e.g. ``compress``).
+
+    Returns
+    -------
+    Dict
+        Conversion report returned by `convert_dta`.
+    """
+    source_description = describe_source(source)
+    start = time.perf_counter()
+    report: dict = {}
+    error = None
+    try:
+        report = convert_dta(
+            source, out, target_version, engine=engine, **options
+        )
+        return report
+    except Exception as exc:
+        error = exc
+        raise
+    finally:
+        event = conversion_event(
+            file,
+            source,
+            out,
+            target_version,
+            engine,
+            time.perf_counter() - start,
+            error,
+            output_path,
+            report.get("cache"),
+            source_description,
+        )
+        events.append(event)
+        if log_format == "json":
+            echo_event(event)
+
+
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.argument(
     "files", nargs=-1, required=False, type=str, metavar="<dta files>"
@@ -70,6 +268,123 @@ CONTEXT_SETTINGS = dict(
     is_flag=True,
     flag_value=True,
 )
+@click.option(
+    "-c",
+    "--compress",
+    help="Downcast variables to their smallest storage type before saving.",
+    is_flag=True,
+    flag_value=True,
+)
+@click.option(
+    "--split-strings",
+    help="Split strings over 244 bytes into extra variables for Stata 10-12.",
+    is_flag=True,
+    flag_value=True,
+)
+@click.option(
+    "--compact-strls",
+    help="Store repeated strings once as strL where smaller (Stata 13+).",
+    is_flag=True,
+    flag_value=True,
+)
+@click.option(
+    "--dedup",
+    help="Convert identical files once and reflink/hardlink/copy the rest.",
+    type=click.Choice(DEDUP_METHODS),
+)
+@click.option(
+    "-e",
+    "--engine",
+    help="How to convert files (auto picks by file size and free memory).",
+    type=click.Choice(ENGINES),
+    default="auto",
+    show_default=True,
+)
+@click.option(
+    "--memory-limit",
+    help="Memory budget in megabytes for --engine auto [available memory].",
+    type=int,
+    metavar="<int>",
+)
+@click.option(
+    "--shard",
+    help="Only convert shard i of N (0-based) of the files, e.g. 0/4.",
+    type=str,
+    metavar="<i/N>",
+)
+@click.option(
+    "--work-steal",
+    help="Claim files with lock files so several processes can share them.",
+    is_flag=True,
+    flag_value=True,
+)
+@click.option(
+    "--lease",
+    help="Seconds before an unfinished claim (--work-steal) expires.",
+    type=float,
+    default=600.0,
+    show_default=True,
+    metavar="<float>",
+)
+@click.option(
+    "--pipeline",
+    help="Overlap reading, converting and writing files in batch mode.",
+    is_flag=True,
+    flag_value=True,
+)
+@click.option(
+    "--buffer-size",
+    help="Megabytes of file contents buffered by --pipeline.",
+    type=int,
+    default=256,
+    show_default=True,
+    metavar="<int>",
+)
+@click.option(
+    "--cache-dir",
+    help="Cache parsed files here to skip parsing them again (needs pyarrow).",
+    type=str,
+    metavar="<path>",
+)
+@click.option(
+    "--cache-size",
+    help="Megabytes kept in --cache-dir (least recently used files go first).",
+    type=int,
+    default=CACHE_SIZE,
+    show_default=True,
+    metavar="<int>",
+)
+@click.option(
+    "--log-format",
+    help="Also print one JSON event per file to stderr with json.",
+    type=click.Choice(LOG_FORMATS),
+    default="text",
+    show_default=True,
+)
+@click.option(
+    "--metrics-file",
+    help="Add counters and latencies to a Prometheus textfile (.prom).",
+    type=str,
+    metavar="<path>",
+)
+@click.option(
+    "--serve",
+    help="Run a server that later rbstata commands are forwarded to.",
+    is_flag=True,
+    flag_value=True,
+)
+@click.option(
+    "--socket",
+    help="Unix socket of the --serve server [$RBSTATA_SOCKET].",
+    type=str,
+    metavar="<path>",
+)
+@click.option(
+    "--workers",
+    help="Worker processes of the --serve server [number of CPUs].",
+    type=int,
+    metavar="<int>",
+)
 @click.option(
     "-v", "--verbose", help="Print messages.", is_flag=True, flag_value=True
 )
@@ -81,6 +396,24 @@ def rbstata(
     all: bool = False,
     overwrite: bool = False,
     recursive: bool = False,
+    compress: bool = False,
+    split_strings: bool = False,
+    compact_strls: bool = False,
+    dedup: Optional[str] = None,
+    engine: str = "auto",
+    memory_limit: Optional[int] = None,
+    shard: Optional[str] = None,
+    work_steal: bool = False,
+    lease: float = 600.0,
+    pipeline: bool = False,
+    buffer_size: int = 256,
+    cache_dir: Optional[str] = None,
+    cache_size: int = CACHE_SIZE,
+    log_format: str = "text",
+    metrics_file: Optional[str] = None,
+    serve: bool = False,
+    socket: Optional[str] = None,
+    workers: Optional[int] = None,
     verbose: bool = False,
 ) -> None:
     """Find your way back to older versions of dta files.
@@ -104,6 +437,78 @@ def rbstata(
         If True, overwrite existing input (source) file. Default is False.
     recursive: bool
         If True, glob dta files in subdirectories. Default is False.
+    compress: bool
+        If True, losslessly downcast variables to the smallest Stata storage
+        type and report the bytes saved per file. Default is False.
+    split_strings: bool
+        If True, split strings longer than 244 bytes into several variables
+        when converting to Stata 10-12 (which have no strL). If False, truncate
+        them and report the number of truncated values per variable. Default
+        is False.
+    compact_strls: bool
+        If True, write string columns as strL (one copy of each distinct
+        value) where that takes less space than fixed-width strings, for
+        Stata 13 and later. strLs cannot be merge keys in Stata. Default is
+        False (only strings longer than 2045 bytes are written as strL).
+    dedup: str
+        (Optional) If given, convert only one file of each group of files with
+        identical contents and materialise the outputs of the others with this
+        method ("reflink", "hardlink" or "copy").
+    engine: str
+        "pandas" reads each file at once, "streaming" reads it in chunks to use
+        less memory, and "binary" copies files whose format the target version
+        can already read. "auto" picks the fastest engine whose estimated peak
+        memory fits the budget. Default is "auto".
+    memory_limit: int
+        (Optional) Memory budget in megabytes for the "auto" engine. If None,
+        use the available memory.
+    shard: str
+        (Optional) Shard specification ``i/N``. Only the files whose path
+        hashes to shard i of N are converted.
+    work_steal: bool
+        If True, claim each file with a lock file before converting it so that
+        multiple processes (possibly on different hosts) can work through the
+        same files without converting any twice. The lock file is next to the
+        output (``<output>.rbstata-lock``) and records the target version, so
+        that a run with another target version converts the files again.
+        Default is False.
+    lease: float
+        Seconds after which an unfinished claim is taken over. Claims are
+        renewed while this process is running. Default is 600.
+    pipeline: bool
+        If True, read the next files in a background thread and write outputs
+        in another while the current file is converted. Default is False.
+    buffer_size: int
+        Megabytes of input and output file contents held in memory by the
+        pipeline. Default is 256.
+    cache_dir: str
+        (Optional) Directory of a persistent cache of parsed dta files (Arrow
+        IPC files keyed by the hash of their contents). Files converted before
+        are loaded from the cache instead of being parsed again. Needs pyarrow.
+    cache_size: int
+        Bound on the size of the cache in megabytes. The least recently used
+        files are evicted first. Default is 10240.
+    log_format: str
+        If "json", print one event per file (path, sizes, source and target
+        formats, engine, duration, rows/s and error, if any) as a line of JSON
+        to stderr. Default is "text".
+    metrics_file: str
+        (Optional) Prometheus textfile (for the node exporter's textfile
+        collector) to which the run's file, byte and row counters and
+        conversion latency histogram are added at exit.
+    serve: bool
+        If True, serve rbstata commands on a Unix socket from a pool of worker
+        processes until interrupted, instead of converting files. The
+        ``rbstata`` command forwards to the server when one is listening, which
+        saves the startup time (mostly importing pandas) of each command, and
+        otherwise runs in process. Default is False.
+    socket: str
+        (Optional) Unix socket of the server. Default is ``$RBSTATA_SOCKET``,
+        else ``rbstata-<uid>.sock`` in ``$XDG_RUNTIME_DIR`` or the temporary
+        directory.
+    workers: int
+        (Optional) Number of worker processes of the server. Default is the
+        number of CPUs.
     verbose: bool
         If True, print messages to stdout. Default is False.
 
@@ -111,6 +516,10 @@ def rbstata(
     -------
     None
     """
+    if serve:
+        serve_forever(socket or socket_path(), workers, verbose)
+        return
+
     if (len(files) == 0) and (not all):
         PROMPT = True
         click.echo(
@@ -194,19 +603,63 @@ def rbstata(
     files = [normalize_filename(f) for f in files]
     files = [normalize_dta_filename(f) for f in files]
 
+    if shard is not None:
+        shard_index, shard_count = parse_shard(shard)
+        files = shard_files(files, shard_index, shard_count)
+
     if verbose:
         click.echo(f"+ Valid dta files to be converted: {files}")
 
+    # Files that must be compressed or have their strLs compacted cannot be
+    # copied as is
+    transform = compress or compact_strls
+    if (engine == "binary") and transform:
+        flag = "--compress" if compress else "--compact-strls"
+        raise ClickException(
+            f"--engine binary copies files as is and cannot {flag} them."
+        )
+
+    if cache_dir is not None:
+        require_pyarrow()
+
+    events: List[dict] = []
+    if metrics_file is not None:
+        click.get_current_context().call_on_close(
+            partial(update_textfile, metrics_file, events)
+        )
+    convert = partial(
+        convert_logged,
+        events=events,
+        log_format=log_format,
+        compress=compress,
+        split_strings=split_strings,
+        compact_strls=compact_strls,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+    )
+
     OVERWRITE_WARNING = (
         "+ Warning: you are writing over original input dta file."
     )
     # Conversion for a single file
-    if len(files) == 1:
+    if (len(files) == 1) and (shard is None) and (not work_steal):
         filename = files[0]
         assert is_dta_file(filename)
         if overwrite:
             click.echo(OVERWRITE_WARNING)
-            convert_dta(filename, filename, target_version)
+            file_engine = pick_engine(
+                filename,
+                filename,
+                target_version,
+                engine,
+                memory_limit,
+                transform,
+                verbose,
+            )
+            report = convert(
+                filename, filename, filename, target_version, file_engine
+            )
+            echo_report(filename, report, compress)
             if verbose:
                 click.secho("+ Converted: ", fg="green", bold=True, nl=False)
                 click.echo(
@@ -219,48 +672,171 @@ def rbstata(
                 output=output,
                 suffix=suffix,
             )
-            convert_dta(filename, out, target_version)
+            file_engine = pick_engine(
+                filename,
+                filename,
+                target_version,
+                engine,
+                memory_limit,
+                transform,
+                verbose,
+            )
+            report = convert(
+                filename, filename, out, target_version, file_engine
+            )
+            echo_report(filename, report, compress)
             if verbose:
                 click.secho("+ Converted: ", fg="green", bold=True, nl=False)
                 click.echo(f"{filename} to {out} in version {target_version}.")
     # Conversion for batch of files
     else:
-        with click.progressbar(
-            files, label="Converting", length=len(files)
-        ) as pb_files:
-            for file in pb_files:
-                try:
-                    is_dta_file(file)
-                except ClickException:
-                    click.secho(
-                        f"Error: {file} is not a valid path to a dta file.",
-                        fg="red",
-                        err=True,
-                    )
-                    continue
-                if overwrite:
-                    click.echo(OVERWRITE_WARNING)
-                    convert_dta(file, file, target_version)
-                    if verbose:
+        duplicates = find_duplicates(files) if dedup else {}
+        deduplicated = {dup for dups in duplicates.values() for dup in dups}
+        files = [f for f in files if f not in deduplicated]
+        # Outputs are claimed, so that another target converts them again
+        job = f"target_version={target_version}"
+
+        def lock_name(file: str) -> str:
+            return get_output_name(
+                file, overwrite=overwrite, output=output, suffix=suffix
+            )
+
+        def claim_output(file: str) -> bool:
+            return claim_file(lock_name(file), lease, job)
+
+        def release(file: str, done: bool = True) -> None:
+            release_file(lock_name(file), done)
+
+        claim = claim_output if work_steal else None
+        beat = ExitStack()
+        if work_steal:
+            beat.enter_context(heartbeat(lease))
+        writer = None
+        if pipeline:
+            # Split the buffer budget between read-ahead and write-behind
+            half_budget = buffer_size * 2**20 // 2
+            sources = prefetch_files(
+                files,
+                ByteBudget(half_budget),
+                claim,
+                partial(release, done=False) if work_steal else None,
+            )
+            writer = BackgroundWriter(ByteBudget(half_budget))
+        else:
+            sources = ((f, None) for f in files)
+        try:
+            with click.progressbar(
+                sources, label="Converting", length=len(files)
+            ) as pb_files:
+                for file, data in pb_files:
+                    try:
+                        is_dta_file(file)
+                    except ClickException as exc:
                         click.secho(
-                            "+ Converted: ", fg="green", bold=True, nl=False
+                            f"Error: {file} is not a valid path to a dta file.",
+                            fg="red",
+                            err=True,
                         )
-                        click.echo(
-                            f"Done overwriting {file} in version {target_version}."
+                        event = conversion_event(
+                            file, file, None, target_version, None, 0.0, exc
                         )
-                else:
+                        events.append(event)
+                        if log_format == "json":
+                            echo_event(event)
+                        continue
+                    if pipeline:
+                        # Claims made ahead may have waited, restart the lease
+                        claimed = (data is not None) and (
+                            (claim is None) or renew_file(lock_name(file))
+                        )
+                    else:
+                        claimed = (claim is None) or claim(file)
+                    if not claimed:
+                        if verbose:
+                            click.echo(f"+ Skipped: {file} claimed elsewhere.")
+                        continue
+
+                    if overwrite:
+                        click.echo(OVERWRITE_WARNING)
                     out = get_output_name(
                         file,
                         overwrite=overwrite,
                         output=output,
                         suffix=suffix,
                     )
-                    convert_dta(file, out, target_version)
+
+                    def finish(file: str = file, out: str = out) -> None:
+                        if work_steal:
+                            release(file)
+                        for dup in duplicates.get(file, []):
+                            dup_out = get_output_name(
+                                dup, overwrite=overwrite, suffix=suffix
+                            )
+                            materialize(out, dup_out, method=str(dedup))
+
+                    try:
+                        if (writer is None) or (data is None):
+                            file_engine = pick_engine(
+                                file,
+                                file,
+                                target_version,
+                                engine,
+                                memory_limit,
+                                transform,
+                                verbose,
+                            )
+                            report = convert(
+                                file, file, out, target_version, file_engine
+                            )
+                            finish()
+                        else:
+                            source = io.BytesIO(data)
+                            file_engine = pick_engine(
+                                file,
+                                source,
+                                target_version,
+                                engine,
+                                memory_limit,
+                                transform,
+                                verbose,
+                            )
+                            buffer = io.BytesIO()
+                            report = convert(
+                                file,
+                                source,
+                                buffer,
+                                target_version,
+                                file_engine,
+                                output_path=out,
+                            )
+                            writer.submit(out, buffer.getvalue(), finish)
+                    except Exception:
+                        if work_steal:
+                            release(file, done=False)
+                        raise
+
+                    if overwrite and verbose:
+                        click.secho(
+                            "+ Converted: ", fg="green", bold=True, nl=False
+                        )
+                        click.echo(
+                            f"Done overwriting {file} in version {target_version}."
+                        )
                     # if False:
                     #     click.secho(
                     #         "+ Converted: ", fg="green", bold=True, nl=False
                     #     )
                     #     click.echo(f"{file} to {out} in version {target_version}.")
+                    echo_report(file, report, compress)
+        finally:
+            # Stops reading ahead and releases files claimed but not converted
+            sources.close()
+            if writer is not None:
+                writer.close()
+            beat.close()
+        if dedup:
+            click.secho("+ Deduplicated: ", fg="green", bold=True, nl=False)
+            click.echo(f"{len(deduplicated)} conversions avoided.")
 
     if verbose:
         if len(files) > 0:
@@ -0,0 +1,130 @@
+"""Thin client that forwards rbstata commands to a running server.
+
+Only the standard library is imported here, so that forwarding a command to
+a server started with ``rbstata --serve`` does not pay for importing pandas.
+"""
+import json
+import os
+import socket
+import stat
+import sys
+import tempfile
+from typing import List, Optional
+
+
+def socket_path(argv: Optional[List[str]] = None) -> str:
+    """Get the path of the server's Unix socket.
+
+    The path is the value of ``--socket`` in `argv` if given, else the
+    ``RBSTATA_SOCKET`` environment variable, else ``rbstata-<uid>.sock`` in
+    ``$XDG_RUNTIME_DIR`` or the temporary directory.
+
+    Parameters
+    ----------
+    argv: list
+        (Optional) Command-line arguments.
+
+    Examples
+    --------
+    >>> socket_path(["auto.dta", "--socket", "/run/rbstata.sock"])
+    '/run/rbstata.sock'
+
+    Returns
+    -------
+    Str
+        Path of the socket.
+    """
+    argv = argv or []
+    for i, arg in enumerate(argv):
+        if arg.startswith("--socket="):
+            return arg.split("=", 1)[1]
+        if (arg == "--socket") and (i + 1 < len(argv)):
+            return argv[i + 1]
+    if os.environ.get("RBSTATA_SOCKET"):
+        return os.environ["RBSTATA_SOCKET"]
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    uid = os.getuid() if hasattr(os, "getuid") else "user"
+    return os.path.join(directory, f"rbstata-{uid}.sock")
+
+
+def is_own_socket(path: str) -> bool:
+    """Check that a path is a socket owned by the current user.
+
+    The default socket is in a shared directory when ``$XDG_RUNTIME_DIR`` is
+    unset, where another user could create it first to receive commands.
+
+    Parameters
+    ----------
+    path: str
+        Path of the socket.
+
+    Examples
+    --------
+    >>> is_own_socket("missing.sock")
+    False
+
+    Returns
+    -------
+    Bool
+        True if `path` is a socket (not a symlink to one) owned by the user.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    uid = os.getuid() if hasattr(os, "getuid") else st.st_uid
+    return stat.S_ISSOCK(st.st_mode) and (st.st_uid == uid)
+
+
+def forward(argv: List[str], path: Optional[str] = None) -> Optional[dict]:
+    """Run a command on the server.
+
+    Parameters
+    ----------
+    argv: list
+        Command-line arguments of rbstata, run in the current directory.
+    path: str
+        (Optional) Socket of the server. Default is `socket_path`.
+
+    Returns
+    -------
+    Dict
+        ``exit_code``, ``stdout`` and ``stderr`` of the command, and
+        ``interactive`` (True if the command prompted for settings, in which
+        case nothing was run). None if no server is listening, or if the
+        socket is not owned by the user (see `is_own_socket`).
+    """
+    path = path or socket_path(argv)
+    if not hasattr(socket, "AF_UNIX") or not is_own_socket(path):
+        return None
+    request = json.dumps(dict(argv=argv, cwd=os.getcwd())).encode()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(request)
+            sock.shutdown(socket.SHUT_WR)
+            response = b"".join(iter(lambda: sock.recv(1 << 16), b""))
+    except OSError:
+        return None
+    return json.loads(response) if response else None
+
+
+def main() -> None:
+    """Run rbstata on a server if one is listening, else in this process.
+
+    Returns
+    -------
+    None
+    """
+    argv = sys.argv[1:]
+    if "--serve" not in argv:
+        response = forward(argv)
+        if (response is not None) and (not response["interactive"]):
+            sys.stdout.write(response["stdout"])
+            sys.stderr.write(response["stderr"])
+            sys.exit(response["exit_code"])
+
+    # Imported here, so that forwarding does not import pandas
+    from rbStata.cli import rbstata
+
+    rbstata()
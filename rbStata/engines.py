@@ -0,0 +1,249 @@
+"""Choose how to convert a dta file given its size and available memory."""
+import os
+import struct
+from typing import IO, Optional, Tuple, Union
+
+ENGINES = ("auto", "pandas", "streaming", "binary")
+
+# Rows read at a time by the streaming engine
+STREAMING_CHUNK_ROWS = 100_000
+
+# Peak memory model, to be tuned against the estimates logged with --verbose.
+# Copies of the data section held at once by reading and DataFrame.to_stata
+PEAK_DATA_COPIES = 4.0
+# Bytes per string value on top of the data section: a separate Python str
+# per value (pandas engine) or a pointer to a shared str (streaming engine)
+STR_VALUE_BYTES = {"pandas": 57, "streaming": 8}
+# Bytes held by the binary engine (copy buffer)
+BINARY_PEAK = 1 << 20
+
+# Memory controller of the cgroup of the process (v2, else v1)
+CGROUP_ROOT = "/sys/fs/cgroup"
+_CGROUP_FILES = (
+    ("memory.max", "memory.current"),
+    ("memory/memory.limit_in_bytes", "memory/memory.usage_in_bytes"),
+)
+# cgroup v1 reports no limit as a huge number (close to 2**63)
+_CGROUP_UNLIMITED = 1 << 60
+
+# Widths in bytes of the storage types of dta 117+ and of older formats
+_TYPE_WIDTHS_117 = {
+    32768: 8,
+    65526: 8,
+    65527: 4,
+    65528: 4,
+    65529: 2,
+    65530: 1,
+}
+_TYPE_WIDTHS_OLD = {251: 1, 252: 2, 253: 4, 254: 4, 255: 8}
+
+
+def read_dta_header(input: Union[str, IO[bytes]]) -> Optional[dict]:
+    """Read the format version, size and storage types of a dta file.
+
+    Only the header and the variable types are read, not the data.
+
+    Parameters
+    ----------
+    input: str or file-like
+        dta file.
+
+    Examples
+    --------
+    >>> header = read_dta_header("assets/datasets/auto.dta")
+    >>> header["release"], header["nobs"], header["nvar"]
+    (118, 74, 12)
+
+    Returns
+    -------
+    Dict
+        ``release`` (dta format, e.g. 118), ``nobs``, ``nvar``, ``widths``
+        (bytes per observation of each variable) and ``nstr`` (number of
+        string variables), or None if the format is not recognized.
+    """
+    if isinstance(input, str):
+        with open(input, "rb") as f:
+            return read_dta_header(f)
+
+    start = input.tell()
+    try:
+        head = input.read(4096)
+        if head.startswith(b"<stata_dta>"):
+
+            def after(tag: bytes) -> int:
+                return head.index(tag) + len(tag)
+
+            release = int(head[after(b"<release>") : head.index(b"</release>")])
+            order = "<" if head[after(b"<byteorder>")] == ord("L") else ">"
+            if release not in (117, 118, 119):
+                return None
+            k_fmt = "I" if release == 119 else "H"
+            n_fmt = "I" if release == 117 else "Q"
+            (nvar,) = struct.unpack_from(order + k_fmt, head, after(b"<K>"))
+            (nobs,) = struct.unpack_from(order + n_fmt, head, after(b"<N>"))
+            pos = after(b"<variable_types>")
+            input.seek(start + pos)
+            codes = struct.unpack(order + "H" * nvar, input.read(2 * nvar))
+            widths = [_TYPE_WIDTHS_117.get(c, c) for c in codes]
+            nstr = sum(1 for c in codes if c <= 2045 or c == 32768)
+        elif head[0] in (113, 114, 115):
+            release = head[0]
+            order = ">" if head[1] == 1 else "<"
+            nvar, nobs = struct.unpack_from(order + "Hi", head, 4)
+            input.seek(start + 109)
+            codes = tuple(input.read(nvar))
+            widths = [_TYPE_WIDTHS_OLD.get(c, c) for c in codes]
+            nstr = sum(1 for c in codes if c <= 244)
+        else:
+            return None
+    except (IndexError, ValueError, struct.error):
+        return None
+    finally:
+        input.seek(start)
+    return dict(release=release, nobs=nobs, nvar=nvar, widths=widths, nstr=nstr)
+
+
+def cgroup_memory(root: str = CGROUP_ROOT) -> Optional[int]:
+    """Get the memory left under the cgroup memory limit, in bytes.
+
+    Containers see the memory of the host in /proc/meminfo, but are killed
+    when they exceed the limit of their cgroup.
+
+    Parameters
+    ----------
+    root: str
+        Mount point of the cgroup filesystem. Default is "/sys/fs/cgroup".
+
+    Returns
+    -------
+    Int
+        Limit minus current usage, or None if there is no limit.
+    """
+    for limit_file, usage_file in _CGROUP_FILES:
+        try:
+            with open(os.path.join(root, limit_file)) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if not limit.isdigit() or int(limit) >= _CGROUP_UNLIMITED:
+            # "max" (cgroup v2)
+            return None
+        try:
+            with open(os.path.join(root, usage_file)) as f:
+                usage = int(f.read())
+        except (OSError, ValueError):
+            usage = 0
+        return max(int(limit) - usage, 0)
+    return None
+
+
+def available_memory() -> Optional[int]:
+    """Get the memory available to new allocations, in bytes.
+
+    Returns
+    -------
+    Int
+        Available memory (capped by the cgroup limit, see `cgroup_memory`), or
+        None if it cannot be determined.
+    """
+    host = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    host = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    if host is None:
+        try:
+            host = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, ValueError, OSError):
+            pass
+    cgroup = cgroup_memory()
+    if host is None or cgroup is None:
+        return cgroup if host is None else host
+    return min(host, cgroup)
+
+
+def estimate_memory(header: dict, engine: str) -> int:
+    """Estimate the peak memory of converting a file with an engine.
+
+    Parameters
+    ----------
+    header: dict
+        Header returned by `read_dta_header`.
+    engine: str
+        One of "pandas", "streaming" or "binary".
+
+    Examples
+    --------
+    >>> header = dict(nobs=1000, widths=[8, 8, 10], nstr=1)
+    >>> estimate_memory(header, "pandas"), estimate_memory(header, "streaming")
+    (161000, 112000)
+
+    Returns
+    -------
+    Int
+        Estimated peak memory in bytes.
+    """
+    if engine == "binary":
+        return BINARY_PEAK
+    data_bytes = header["nobs"] * sum(header["widths"])
+    str_bytes = header["nobs"] * header["nstr"] * STR_VALUE_BYTES[engine]
+    return int(PEAK_DATA_COPIES * data_bytes + str_bytes)
+
+
+def select_engine(
+    input: Union[str, IO[bytes]],
+    version: Optional[int],
+    memory_limit: Optional[int] = None,
+    transform: bool = False,
+) -> Tuple[str, dict]:
+    """Pick the fastest engine whose estimated peak memory fits the budget.
+
+    The binary engine copies the file as is, which is possible only if its
+    format is already readable by the target version and nothing has to be
+    transformed. The pandas engine reads the whole file at once. The streaming
+    engine reads the file in chunks and shares repeated strings, which takes
+    longer but less memory.
+
+    Parameters
+    ----------
+    input: str or file-like
+        Input (source) dta file.
+    version: int
+        dta format to convert to (114, 117, 118, or None for 118/119).
+    memory_limit: int
+        (Optional) Memory budget in bytes. If None, use the available memory.
+    transform: bool
+        If True, the data must be transformed (e.g., compressed), so that the
+        file cannot be copied as is. Default is False.
+
+    Returns
+    -------
+    Tuple
+        Engine and a dict describing the decision (``estimates`` per engine
+        and the ``budget``, both in bytes, and ``fits``). If no engine fits
+        the budget, ``fits`` is False and the engine that needs the least
+        memory is returned, which may still run out of memory: the streaming
+        engine also builds the whole DataFrame, and saves memory only on
+        repeated strings.
+    """
+    header = read_dta_header(input)
+    budget = memory_limit if memory_limit is not None else available_memory()
+    decision: dict = dict(header=header, budget=budget, estimates={}, fits=True)
+    if header is None:
+        return "pandas", decision
+
+    candidates = ["pandas", "streaming"]
+    if (not transform) and (header["release"] <= (version or 119)):
+        candidates.insert(0, "binary")
+    for engine in candidates:
+        decision["estimates"][engine] = estimate_memory(header, engine)
+    for engine in candidates:
+        if (budget is None) or (decision["estimates"][engine] <= budget):
+            return engine, decision
+    # Nothing fits, so take the engine that needs the least memory
+    decision["fits"] = False
+    return candidates[-1], decision
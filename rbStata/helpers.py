@@ -1,16 +1,70 @@
 """Helpers."""
+import inspect
+import itertools
+import os
 import re
+import shutil
 import warnings
+from contextlib import ExitStack
 from glob import glob
 from pathlib import Path
-from typing import Optional
+from typing import IO, Dict, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
 from anyascii import anyascii
 from click import ClickException
 
+from rbStata.cache import (
+    CACHE_SIZE,
+    file_digest,
+    load_cached,
+    require_pyarrow,
+    store_cached,
+)
+from rbStata.engines import STREAMING_CHUNK_ROWS, read_dta_header
+
 warnings.simplefilter(action="ignore", category=Warning)
 
+# dta format written for each Stata version (None lets pandas pick 118/119)
+STATA_VERSIONS = {
+    10: 114,
+    11: 114,
+    12: 114,
+    13: 117,
+    14: 118,
+    15: None,
+    16: None,
+    17: None,
+}
+
+# Bytes per observation of Stata's numeric storage types
+STATA_TYPE_WIDTHS = {"b": 1, "h": 2, "l": 4, "f": 4, "d": 8}
+
+# Longest fixed-width string (str#) for each dta version
+STATA_STR_MAX = {114: 244, 117: 2045, 118: 2045}
+
+# Approximate bytes taken by a GSO entry besides its contents
+GSO_OVERHEAD = 17
+
+# pandas 3 renamed the convert_strL argument of to_stata to convert_strl
+CONVERT_STRL = (
+    "convert_strl"
+    if "convert_strl" in inspect.signature(pd.DataFrame.to_stata).parameters
+    else "convert_strL"
+)
+
+# Cells (observations x variables) handled at a time by block-wise helpers,
+# so that wide datasets are processed in a few vectorized steps
+BLOCK_CELLS = 1_000_000
+
+# Smallest to largest Stata integer types with their valid (non-missing) range
+STATA_INT_RANGES = [
+    (np.int8, -127, 100),
+    (np.int16, -32767, 32740),
+    (np.int32, -2147483647, 2147483620),
+]
+
 
 def normalize_filename(filename: str) -> str:
     """Normalize filenames by removing whitespaces.
@@ -93,68 +147,694 @@ def is_dta_file(filename: str) -> bool:
         raise ClickException(f"{filename} is not a valid path to a dta file.")
 
 
-def convert_dta(input: str, output: str, target_version: int) -> None:
+def storage_widths(df: pd.DataFrame) -> Dict[str, int]:
+    """Get the bytes per observation each column takes up when written to Stata.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Data to be written.
+
+    Examples
+    --------
+    >>> storage_widths(pd.DataFrame({"x": [1.0, 2.0], "s": ["a", "abc"]}))
+    {'x': 8, 's': 3}
+
+    Returns
+    -------
+    Dict
+        Mapping from column name to storage width in bytes.
+    """
+    widths = {}
+    for col, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            widths[col] = df[col].cat.codes.dtype.itemsize
+        elif pd.api.types.is_numeric_dtype(dtype):
+            widths[col] = dtype.itemsize
+        else:
+            nbytes = df[col].dropna().astype(str).str.encode("utf-8").str.len()
+            widths[col] = max(int(nbytes.max()), 1) if len(nbytes) else 1
+    return widths
+
+
+def _stata_int_type(lo: float, hi: float) -> Optional[type]:
+    """Get the smallest Stata integer type that holds values in [lo, hi]."""
+    for dtype, type_min, type_max in STATA_INT_RANGES:
+        if (lo >= type_min) and (hi <= type_max):
+            return dtype
+    return None
+
+
+def compress_dta(
+    df: pd.DataFrame, source_widths: Optional[Dict[str, int]] = None
+) -> Tuple[pd.DataFrame, int]:
+    """Losslessly downcast columns to the smallest Stata storage type.
+
+    This mirrors Stata's ``compress``: integer-valued columns without missing
+    values become byte, int or long, and doubles that round-trip through float
+    become float. Strings are written at their observed maximum byte length.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Data to compress.
+    source_widths: dict
+        (Optional) Storage widths of the columns in the source file. If None,
+        use the widths of `df` as given.
+
+    Examples
+    --------
+    >>> df, saved = compress_dta(pd.DataFrame({"x": [1.0, 2.0]}))
+    >>> df["x"].dtype, saved
+    (dtype('int8'), 14)
+
+    Returns
+    -------
+    Tuple
+        Compressed data and number of bytes saved in the data section.
+    """
+    if source_widths is None:
+        source_widths = storage_widths(df)
+
+    num = df.select_dtypes(include=["integer", "floating"])
+    lo, hi = num.min(), num.max()
+    has_na = num.isna().any()
+    floats = num.select_dtypes(include="floating")
+    integral = ((floats % 1 == 0) | floats.isna()).all()
+    as_float32 = floats.astype(np.float32).astype(np.float64)
+    fits_float32 = ((as_float32 == floats) | floats.isna()).all()
+
+    targets = {}
+    for col, dtype in num.dtypes.items():
+        is_float = pd.api.types.is_float_dtype(dtype)
+        int_type = None
+        if not (has_na[col] or (is_float and not integral[col])):
+            int_type = _stata_int_type(lo[col], hi[col])
+        if int_type is not None:
+            if np.dtype(int_type).itemsize < dtype.itemsize or is_float:
+                targets[col] = int_type
+        elif (dtype == np.float64) and fits_float32[col]:
+            targets[col] = np.float32
+    df = df.astype(targets)
+
+    widths = storage_widths(df)
+    saved = sum(source_widths.get(col, w) - w for col, w in widths.items())
+    return df, max(saved, 0) * len(df)
+
+
+def string_columns(df: pd.DataFrame) -> List[str]:
+    """Get the names of the string columns of a DataFrame.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Data.
+
+    Examples
+    --------
+    >>> string_columns(pd.DataFrame({"x": [1], "s": ["a"]}))
+    ['s']
+
+    Returns
+    -------
+    List
+        Column names.
+    """
+    return list(df.select_dtypes(include=["object", "string"]).columns)
+
+
+def column_blocks(df: pd.DataFrame, columns: List[str]) -> Iterator[List[str]]:
+    """Split columns into blocks of at most `BLOCK_CELLS` cells.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Data.
+    columns: list
+        Columns to split, usually of the same storage type.
+
+    Examples
+    --------
+    >>> list(column_blocks(pd.DataFrame({"a": [1], "b": [2]}), ["a", "b"]))
+    [['a', 'b']]
+
+    Returns
+    -------
+    Iterator
+        Lists of column names.
+    """
+    size = max(1, BLOCK_CELLS // max(len(df), 1))
+    for start in range(0, len(columns), size):
+        yield columns[start : start + size]
+
+
+def _needs_ascii(value: object, encoding: str = "ascii") -> bool:
+    if not isinstance(value, str) or value.isascii():
+        return False
+    try:
+        value.encode(encoding)
+    except UnicodeEncodeError:
+        return True
+    return False
+
+
+def _encode(value: str, encoding: str) -> bytes:
+    try:
+        return value.encode(encoding)
+    except UnicodeEncodeError:
+        return anyascii(value).encode("ascii")
+
+
+def _str_len(value: object) -> int:
+    return len(value) if isinstance(value, str) else 0
+
+
+def object_strings(
+    df: pd.DataFrame,
+    ascii: bool = False,
+    columns: Optional[List[str]] = None,
+    encoding: str = "ascii",
+) -> pd.DataFrame:
+    """Store all string columns as dtype object, with None for missing values.
+
+    This is what ``DataFrame.to_stata`` does column by column. Doing it in
+    blocks of columns (see `column_blocks`) leaves the strings in one block of
+    dtype object, which is much faster for datasets with thousands of
+    variables.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Data.
+    ascii: bool
+        If True, also transliterate the strings that `encoding` cannot encode
+        to ASCII with anyascii. Default is False.
+    columns: list
+        (Optional) String columns to convert. Default is all of them.
+    encoding: str
+        Encoding that strings must fit in if `ascii` is True. Default is
+        "ascii" (transliterate all non-ASCII strings).
+
+    Examples
+    --------
+    >>> df = object_strings(pd.DataFrame({"x": [1, 2], "s": ["Zürich", None]}), ascii=True)
+    >>> df["s"].tolist(), df["s"].dtype
+    (['Zurich', None], dtype('O'))
+    >>> object_strings(pd.DataFrame({"s": ["Zürich", "Łódź"]}), ascii=True, encoding="latin-1")["s"].tolist()
+    ['Zürich', 'Lodz']
+
+    Returns
+    -------
+    pd.DataFrame
+        Data with the columns in the same order.
+    """
+    if columns is None:
+        columns = string_columns(df)
+    if not columns:
+        return df
+    parts = [df.drop(columns=columns)]
+    for block in column_blocks(df, columns):
+        values = df[block].to_numpy(dtype=object, copy=True)
+        values[pd.isna(values)] = None
+        if ascii:
+            needs_ascii = np.frompyfunc(
+                lambda x: _needs_ascii(x, encoding), 1, 1
+            )(values).astype(bool)
+            values[needs_ascii] = [anyascii(x) for x in values[needs_ascii]]
+        parts.append(
+            pd.DataFrame(values, index=df.index, columns=block, dtype=object)
+        )
+    return pd.concat(parts, axis=1)[list(df.columns)]
+
+
+def ascii_categories(df: pd.DataFrame, encoding: str = "ascii") -> pd.DataFrame:
+    """Transliterate the categories (value labels) of categorical columns.
+
+    Categories that `encoding` cannot encode are transliterated to ASCII with
+    anyascii. Categories that become equal are merged.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Data.
+    encoding: str
+        Encoding that categories must fit in. Default is "ascii".
+
+    Examples
+    --------
+    >>> df = pd.DataFrame({"c": pd.Categorical(["Łódź", "Kraków"])})
+    >>> ascii_categories(df, "latin-1")["c"].tolist()
+    ['Lodz', 'Kraków']
+
+    Returns
+    -------
+    pd.DataFrame
+        Data with the columns in the same order.
+    """
+    columns = {}
+    for col in df.select_dtypes(include="category").columns:
+        values = df[col]
+        categories = list(values.cat.categories)
+        renamed = [
+            anyascii(c) if _needs_ascii(c, encoding) else c for c in categories
+        ]
+        if renamed == categories:
+            continue
+        if len(set(renamed)) == len(renamed):
+            columns[col] = values.cat.rename_categories(renamed)
+        else:
+            dtype = pd.CategoricalDtype(
+                list(dict.fromkeys(renamed)), ordered=values.cat.ordered
+            )
+            mapping = dict(zip(categories, renamed))
+            columns[col] = values.astype(object).map(mapping).astype(dtype)
+    return df.assign(**columns) if columns else df
+
+
+def share_strings(
+    col: pd.Series, cache: Optional[dict] = None, encoding: Optional[str] = None
+) -> pd.Series:
+    """Make repeated values of a string column share one Python object.
+
+    Parameters
+    ----------
+    col: pd.Series
+        String column.
+    cache: dict
+        (Optional) Strings seen before (e.g., in previous chunks of the same
+        column), which are reused and updated.
+    encoding: str
+        (Optional) Encode the values to bytes in this encoding, once per
+        distinct value. Strings it cannot encode are transliterated to ASCII.
+
+    Returns
+    -------
+    pd.Series
+        Column of dtype object where equal values are the same object.
+    """
+    codes, uniques = pd.factorize(col)
+    uniques = np.asarray(uniques, dtype=object)
+    if cache is not None:
+        uniques[:] = [cache.setdefault(u, u) for u in uniques]
+    if encoding is not None:
+        uniques[:] = [_encode(u, encoding) for u in uniques]
+    values = uniques.take(codes)
+    values[codes == -1] = None
+    return pd.Series(values, index=col.index, name=col.name, dtype=object)
+
+
+def choose_strls(
+    df: pd.DataFrame, version: int, save_space: bool = False
+) -> List[str]:
+    """Pick the string columns to write as strL for dta versions 117 and 118.
+
+    A column is written as strL if it has strings longer than str2045 allows.
+    With `save_space`, it is also written as strL if storing its distinct
+    values once (as GSOs shared by all observations) takes less space than
+    fixed-width strings. strLs are more restricted than str# in Stata (e.g.,
+    they cannot be merge keys), hence this is opt-in.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Data to be written.
+    version: int
+        dta version (117 or 118).
+    save_space: bool
+        If True, also pick columns that take less space as strL. Default is
+        False.
+
+    Examples
+    --------
+    >>> df = pd.DataFrame({"s": ["x" * 100] * 10, "t": ["a"] * 10})
+    >>> choose_strls(df, 117), choose_strls(df, 117, save_space=True)
+    ([], ['s'])
+
+    Returns
+    -------
+    List
+        Names of the columns to write as strL.
+    """
+    encoding = "latin-1" if version == 117 else "utf-8"
+    strls = []
+    for block in column_blocks(df, string_columns(df)):
+        # Distinct values of all columns of the block at once, in long format
+        values = df[block].to_numpy(dtype=object)
+        pairs = pd.DataFrame(
+            {
+                "col": np.repeat(np.arange(len(block)), len(df)),
+                "value": pd.Series(values.ravel(order="F"), dtype=object),
+            }
+        )
+        uniques = pairs.dropna().drop_duplicates()
+        nbytes = (
+            uniques["value"].str.encode(encoding, errors="replace").str.len()
+        )
+        stats = nbytes.groupby(uniques["col"]).agg(["max", "sum", "count"])
+        fixed_size = len(df) * stats["max"]
+        strl_size = 8 * len(df) + stats["sum"] + GSO_OVERHEAD * stats["count"]
+        is_strl = (stats["max"] > STATA_STR_MAX[version]) | (
+            save_space & (strl_size < fixed_size)
+        )
+        strls += [block[i] for i in stats.index[is_strl]]
+    return strls
+
+
+def fit_str244(
+    df: pd.DataFrame, variable_labels: Dict[str, str], split: bool = False
+) -> Tuple[pd.DataFrame, Dict[str, str], Dict[str, int]]:
+    """Fit string columns into str244 for dta version 114 (no strL).
+
+    Strings that latin-1 (the encoding of dta 114) cannot encode are
+    transliterated to ASCII with anyascii, after which strings longer than 244
+    bytes are truncated, or split into extra variables ``<name>_2``,
+    ``<name>_3``, ... holding the following 244-byte pieces.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Data to be written.
+    variable_labels: dict
+        Variable labels, extended with labels of variables added by `split`.
+    split: bool
+        If True, split long strings instead of truncating them. Default is
+        False.
+
+    Examples
+    --------
+    >>> df, labels, truncated = fit_str244(pd.DataFrame({"s": ["x" * 300]}), {})
+    >>> df["s"].str.len().tolist(), truncated
+    ([244], {'s': 1})
+    >>> fit_str244(pd.DataFrame({"s": ["Zürich", "Łódź"]}), {})[0]["s"].tolist()
+    ['Zürich', 'Lodz']
+
+    Returns
+    -------
+    Tuple
+        Data, variable labels, and number of truncated values per variable
+        (only variables with truncated values).
+    """
+    max_len = STATA_STR_MAX[114]
+    truncated = {}
+    df = object_strings(df, ascii=True, encoding="latin-1")
+    long_columns = []
+    for block in column_blocks(df, string_columns(df)):
+        values = df[block].to_numpy(dtype=object)
+        lengths = np.frompyfunc(_str_len, 1, 1)(values).max(axis=0, initial=0)
+        long_columns += [col for col, n in zip(block, lengths) if n > max_len]
+    for col in long_columns:
+        values = df[col].copy()
+        is_str = values.map(lambda x: isinstance(x, str)).astype(bool)
+        strings = values[is_str]
+        # All strings are latin-1 now, so lengths in characters are in bytes
+        lengths = strings.str.len()
+        if split:
+            position = df.columns.get_loc(col)
+            label = variable_labels.get(col, "")
+            pieces = range(1, int(lengths.max() - 1) // max_len + 1)
+            taken = set(df.columns)
+            names = {}
+            for piece in pieces:
+                names[piece] = _split_name(col, piece + 1, taken)
+                taken.add(names[piece])
+            for piece in reversed(pieces):
+                name = names[piece]
+                chunk = pd.Series("", index=values.index, dtype=object)
+                chunk[is_str] = strings.str.slice(
+                    piece * max_len, (piece + 1) * max_len
+                )
+                df.insert(position + 1, name, chunk)
+                variable_labels[name] = f"{label[:72]} ({piece + 1})"
+        else:
+            truncated[col] = int((lengths > max_len).sum())
+        values[is_str] = strings.str.slice(0, max_len)
+        df[col] = values
+    return df, variable_labels, truncated
+
+
+def _split_name(col: str, number: int, taken: set) -> str:
+    # <col>_<number>, else <col>_<number>_<n>, within Stata's 32 characters
+    for n in itertools.count():
+        suffix = f"_{number}" if n == 0 else f"_{number}_{n}"
+        name = f"{col[: 32 - len(suffix)]}{suffix}"
+        if name not in taken:
+            return name
+    raise AssertionError  # pragma: no cover
+
+
+def read_dta_chunked(
+    reader_obj: pd.io.stata.StataReader, chunksize: int = STREAMING_CHUNK_ROWS
+) -> pd.DataFrame:
+    """Read the data of a dta file in chunks of rows.
+
+    Unlike reading the file at once, the raw data section is never held in
+    memory as a whole, and repeated strings share one Python object.
+
+    Parameters
+    ----------
+    reader_obj: pd.io.stata.StataReader
+        Reader returned by ``pd.read_stata(..., iterator=True)``.
+    chunksize: int
+        Rows read at a time. Default is `STREAMING_CHUNK_ROWS`.
+
+    Returns
+    -------
+    pd.DataFrame
+        Data.
+    """
+    chunks: Dict[str, List[pd.Series]] = {}
+    caches: Dict[str, dict] = {}
+    first = None
+    while True:
+        try:
+            chunk = reader_obj.read(nrows=chunksize)
+        except StopIteration:
+            break
+        if first is None:
+            first = chunk
+        if len(chunk) == 0:
+            break
+        strings = set(string_columns(chunk))
+        for col in chunk.columns:
+            values = chunk[col]
+            if col in strings:
+                values = share_strings(values, caches.setdefault(col, {}))
+            chunks.setdefault(col, []).append(values)
+    if first is None or len(first) == 0:
+        return reader_obj.read() if first is None else first
+
+    # Each chunk only has the categories of the labelled values it contains.
+    # As when reading at once, keep the categories present, ordered by value.
+    value_labels = reader_obj.value_labels()
+    lbllist = dict(zip(first.columns, getattr(reader_obj, "_lbllist", [])))
+
+    def combine(col: str, parts: List[pd.Series]) -> pd.Series:
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            vl = value_labels.get(lbllist.get(col, ""), {})
+            codes = {label: code for code, label in vl.items()}
+            seen = dict.fromkeys(c for p in parts for c in p.cat.categories)
+            categories = sorted(seen, key=lambda c: codes.get(c, c))
+            parts = [part.cat.set_categories(categories) for part in parts]
+        return pd.concat(parts, ignore_index=True)
+
+    return pd.DataFrame(
+        {col: combine(col, chunks.pop(col)) for col in list(chunks)}
+    )
+
+
+def copy_dta(
+    input: Union[str, IO[bytes]],
+    output: Union[str, IO[bytes]],
+    version: Optional[int],
+) -> None:
+    """Copy a dta file that the target version can already read.
+
+    Parameters
+    ----------
+    input: str or file-like
+        Input (source) dta file.
+    output: str or file-like
+        Output (destination) dta file.
+    version: int
+        dta format of the target version (see `STATA_VERSIONS`).
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    ClickException
+        If the format of the input is newer than the target format.
+    """
+    header = read_dta_header(input)
+    if (header is None) or (header["release"] > (version or 119)):
+        raise ClickException(
+            f"{input} cannot be copied as is to dta format {version}."
+        )
+    if isinstance(input, str) and isinstance(output, str):
+        if not (os.path.exists(output) and os.path.samefile(input, output)):
+            shutil.copyfile(input, output)
+        return
+    with ExitStack() as stack:
+        if isinstance(input, str):
+            input = stack.enter_context(open(input, "rb"))
+        if isinstance(output, str):
+            output = stack.enter_context(open(output, "wb"))
+        shutil.copyfileobj(input, output)
+
+
+def convert_dta(
+    input: Union[str, IO[bytes]],
+    output: Union[str, IO[bytes]],
+    target_version: int,
+    compress: bool = False,
+    split_strings: bool = False,
+    compact_strls: bool = False,
+    engine: str = "pandas",
+    cache_dir: Optional[str] = None,
+    cache_size: int = CACHE_SIZE,
+) -> dict:
     """Convert dta file.
 
     This function takes care of mapping Stata versions to the versions
     recognized by pandas. The function also takes care of UnicodeEncodeError's
     by converting unicode strings to ascii using the anyascii package.
 
+    Strings longer than str2045 are written as strL (see `choose_strls`), or
+    fitted into str244 for Stata 10-12, which have no strL (see
+    `fit_str244`).
+
     Parameters
     ----------
-    input: str
+    input: str or file-like
         Input (source) dta file to convert.
-    output: str
+    output: str or file-like
         Output (destination) dta file after conversion.
     target_version: int
         Stata version to convert to.
+    compress: bool
+        If True, downcast columns to their smallest storage type before
+        writing (see `compress_dta`). Default is False.
+    split_strings: bool
+        If True, split strings longer than 244 bytes into several variables
+        instead of truncating them when converting to Stata 10-12. Default is
+        False.
+    compact_strls: bool
+        If True, also write string columns as strL where storing each
+        distinct value once takes less space, for Stata 13 and later. Default
+        is False.
+    engine: str
+        "pandas" to read the whole file at once, "streaming" to read it in
+        chunks (see `read_dta_chunked`), or "binary" to copy it as is (see
+        `copy_dta`). Default is "pandas".
+    cache_dir: str
+        (Optional) Directory of a cache of parsed dta files, keyed by their
+        contents (see `load_cached`). On a hit, the file is not parsed again.
+        Needs pyarrow.
+    cache_size: int
+        Bound on the total size of the cache in megabytes. Default is
+        `CACHE_SIZE`.
 
     Example
     -------
-    >>> convert_dta("assets/datasets/auto.dta", "assets/datasets/doctest-out.dta", 13)
+    >>> report = convert_dta("assets/datasets/auto.dta", "assets/datasets/doctest-out.dta", 13)
 
     Returns
     -------
-    None
+    Dict
+        Conversion report. ``bytes_saved`` is the number of bytes saved by
+        compression, ``truncated`` the number of truncated strings per
+        variable and ``cache`` "hit", "miss" or None (no cache).
     """
-    map_versions = {
-        10: 114,
-        11: 114,
-        12: 114,
-        13: 117,
-        14: 118,
-        15: None,
-        16: None,
-        17: None,
-    }
-    version = map_versions[target_version]
-
-    reader_obj = pd.read_stata(input, iterator=True)
-    data_label = reader_obj.data_label
-    variable_labels = reader_obj.variable_labels()
+    version = STATA_VERSIONS[target_version]
+    report: dict = dict(bytes_saved=0, truncated={}, cache=None)
+
+    if engine == "binary":
+        if compress or compact_strls:
+            raise ClickException(
+                "The binary engine copies files as is and cannot compress them "
+                "or compact their strLs."
+            )
+        copy_dta(input, output, version)
+        return report
+
+    cached = None
+    if cache_dir is not None:
+        require_pyarrow()
+        key = file_digest(input)
+        cached = load_cached(cache_dir, key)
+        report["cache"] = "miss" if cached is None else "hit"
+    if cached is not None:
+        df, meta = cached
+        data_label = meta["data_label"]
+        variable_labels = meta["variable_labels"]
+        typlist = meta["typlist"]
+    else:
+        with pd.read_stata(input, iterator=True) as reader_obj:
+            data_label = reader_obj.data_label
+            variable_labels = reader_obj.variable_labels()
+            typlist = getattr(reader_obj, "_typlist", [])
+            if engine == "streaming":
+                df = read_dta_chunked(reader_obj)
+            else:
+                df = reader_obj.read()
+            value_labels = reader_obj.value_labels()
+        if cache_dir is not None:
+            meta = dict(
+                data_label=data_label,
+                variable_labels=variable_labels,
+                typlist=typlist,
+                value_labels=value_labels,
+            )
+            store_cached(cache_dir, key, df, meta, cache_size * 2**20)
 
     # Variable labels must be 80 chars or fewer
-    for key, val in variable_labels.items():
-        if len(val) >= 80:
-            variable_labels[key] = val[:80]
-
-    std_opts_tostata = dict(
-        version=version,
-        write_index=False,
-        data_label=data_label,
-        variable_labels=variable_labels,
-    )
+    variable_labels = {key: val[:80] for key, val in variable_labels.items()}
+
+    if compress:
+        # strLs (typ "Q") are not fixed width and are left out
+        source_widths = {
+            col: typ if isinstance(typ, int) else STATA_TYPE_WIDTHS[typ]
+            for col, typ in zip(variable_labels, typlist)
+            if typ != "Q"
+        }
+        df, report["bytes_saved"] = compress_dta(df, source_widths or None)
+
+    strls = None
+    if version == 114:
+        df, variable_labels, report["truncated"] = fit_str244(
+            df, variable_labels, split=split_strings
+        )
+    else:
+        strls = choose_strls(df, version or 118, save_space=compact_strls)
+        # pandas writes str strLs as UTF-8, which Stata 13 reads as latin-1,
+        # but writes bytes as is
+        encoding = "latin-1" if version == 117 else None
+        for col in strls:
+            df[col] = share_strings(df[col], encoding=encoding)
+
+    std_opts_tostata = {
+        "version": version,
+        "write_index": False,
+        "data_label": data_label,
+        "variable_labels": variable_labels,
+        CONVERT_STRL: strls,
+    }
 
+    df = object_strings(df)
     try:
-        pd.read_stata(input).to_stata(output, **std_opts_tostata)
+        df.to_stata(output, **std_opts_tostata)
     except UnicodeEncodeError:
-        df = pd.read_stata(input)
-        for col in df.columns:
-            try:
-                df[col] = df[col].apply(lambda x: anyascii(x))
-            except TypeError:
-                pass
+        # dta 114 and 117 are latin-1, so only what it cannot encode is lost
+        df = object_strings(df, ascii=True, encoding="latin-1")
+        df = ascii_categories(df, encoding="latin-1")
+        if not isinstance(output, str):
+            # Discard what was written before the error
+            output.seek(0)
+            output.truncate()
         df.to_stata(output, **std_opts_tostata)
+    return report
 
 
 def add_suffix(filename: str, suffix: str) -> str:
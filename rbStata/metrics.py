@@ -0,0 +1,311 @@
+"""Structured events and Prometheus metrics for conversions."""
+import json
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import IO, Dict, Iterator, List, Optional, Union
+
+import click
+
+from rbStata.engines import read_dta_header
+
+LOG_FORMATS = ("text", "json")
+
+# Upper bounds in seconds of the buckets of the conversion latency histogram
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+# Metric families written to the textfile: (type, help)
+METRICS = {
+    "rbstata_files_total": ("counter", "Files processed by status and engine."),
+    "rbstata_bytes_read_total": ("counter", "Bytes of input dta files."),
+    "rbstata_bytes_written_total": ("counter", "Bytes of output dta files."),
+    "rbstata_rows_total": ("counter", "Observations converted."),
+    "rbstata_conversion_duration_seconds": (
+        "histogram",
+        "Time to convert a file.",
+    ),
+    "rbstata_last_run_timestamp_seconds": (
+        "gauge",
+        "Unix time of the end of the last run.",
+    ),
+}
+
+_SAMPLE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*(?:\{.*\})?)\s+(\S+)")
+
+
+def _size(obj: Union[None, str, IO[bytes]]) -> Optional[int]:
+    if obj is None:
+        return None
+    if isinstance(obj, str):
+        return os.path.getsize(obj) if os.path.isfile(obj) else None
+    position = obj.tell()
+    size = obj.seek(0, os.SEEK_END)
+    obj.seek(position)
+    return size
+
+
+def _header(obj: Union[None, str, IO[bytes]]) -> Optional[dict]:
+    if obj is None:
+        return None
+    if isinstance(obj, str):
+        try:
+            return read_dta_header(obj)
+        except OSError:
+            return None
+    position = obj.tell()
+    obj.seek(0)
+    try:
+        return read_dta_header(obj)
+    finally:
+        obj.seek(position)
+
+
+def _error_type(error: BaseException) -> str:
+    cls = type(error)
+    if cls.__module__ == "builtins":
+        return cls.__qualname__
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def describe_source(source: Union[str, IO[bytes]]) -> dict:
+    """Get the size and header of a source file before it is converted.
+
+    With ``--overwrite``, the output replaces the source, so these must be
+    read before the conversion.
+
+    Parameters
+    ----------
+    source: str or file-like
+        Input (source) dta file, or its contents.
+
+    Returns
+    -------
+    Dict
+        ``bytes`` (size of the file) and ``header`` (see `read_dta_header`).
+    """
+    return dict(bytes=_size(source), header=_header(source))
+
+
+def conversion_event(
+    file: str,
+    source: Union[str, IO[bytes]],
+    output: Union[None, str, IO[bytes]],
+    target_version: int,
+    engine: Optional[str],
+    seconds: float,
+    error: Optional[BaseException] = None,
+    output_path: Optional[str] = None,
+    cache: Optional[str] = None,
+    source_description: Optional[dict] = None,
+) -> dict:
+    """Describe the conversion of one file.
+
+    Parameters
+    ----------
+    file: str
+        Input (source) dta file.
+    source: str or file-like
+        Input (source) dta file, or its contents.
+    output: str or file-like
+        (Optional) Output dta file, or its contents. None if there is none.
+    target_version: int
+        Stata version converted to.
+    engine: str
+        (Optional) Engine used.
+    seconds: float
+        Duration of the conversion.
+    error: Exception
+        (Optional) Error raised by the conversion.
+    output_path: str
+        (Optional) Path the output is written to, if `output` is a buffer.
+    cache: str
+        (Optional) "hit" or "miss" if a cache of parsed files was used.
+    source_description: dict
+        (Optional) Source described by `describe_source` before the
+        conversion. Default is to describe `source` now.
+
+    Returns
+    -------
+    Dict
+        JSON-serializable event. ``source_format`` and ``target_format`` are
+        dta formats (e.g. 118 and 117) read from the file headers.
+    """
+    if source_description is None:
+        source_description = describe_source(source)
+    source_header = source_description["header"]
+    output_header = None if error else _header(output)
+    rows = source_header["nobs"] if source_header else None
+    return dict(
+        event="convert",
+        time=datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+        path=file,
+        output=output if isinstance(output, str) else output_path,
+        status="error" if error else "ok",
+        bytes_in=source_description["bytes"],
+        bytes_out=None if error else _size(output),
+        source_format=source_header["release"] if source_header else None,
+        target_version=target_version,
+        target_format=output_header["release"] if output_header else None,
+        engine=engine,
+        cache=cache,
+        rows=rows,
+        duration_s=round(seconds, 6),
+        rows_per_s=(
+            round(rows / seconds, 1)
+            if (rows is not None) and (seconds > 0) and not error
+            else None
+        ),
+        error=(
+            dict(type=_error_type(error), message=str(error)) if error else None
+        ),
+    )
+
+
+def echo_event(event: dict) -> None:
+    """Print an event as one line of JSON to stderr.
+
+    Parameters
+    ----------
+    event: dict
+        Event returned by `conversion_event`.
+
+    Returns
+    -------
+    None
+    """
+    click.echo(json.dumps(event), err=True)
+
+
+def read_textfile(path: str) -> Dict[str, float]:
+    """Read the samples of a Prometheus textfile.
+
+    Parameters
+    ----------
+    path: str
+        Textfile. A missing file has no samples.
+
+    Examples
+    --------
+    >>> read_textfile("missing.prom")
+    {}
+
+    Returns
+    -------
+    Dict
+        Value of each sample, keyed by name and labels (e.g.
+        ``rbstata_files_total{engine="pandas",status="ok"}``).
+    """
+    samples: Dict[str, float] = {}
+    if not os.path.isfile(path):
+        return samples
+    with open(path) as f:
+        for line in f:
+            match = _SAMPLE.match(line)
+            if match and not line.startswith("#"):
+                samples[match.group(1)] = float(match.group(2))
+    return samples
+
+
+def _labels(**labels: object) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _bound(key: str) -> float:
+    match = re.search(r'le="([^"]+)"', key)
+    return float(match.group(1)) if match else 0.0
+
+
+@contextmanager
+def _locked(path: str) -> Iterator[None]:
+    """Hold an exclusive lock on the sidecar lock file of a textfile."""
+    try:
+        import fcntl
+    except ImportError:
+        # Not POSIX: runs are not serialized
+        yield
+        return
+    with open(f"{path}.lock", "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def update_textfile(path: str, events: List[dict]) -> None:
+    """Add the events of a run to the metrics of a Prometheus textfile.
+
+    Counters and histograms are cumulative over runs: the samples already in
+    the file are read and incremented, under a lock on ``<path>.lock`` so that
+    concurrent runs do not lose updates. The file is replaced atomically, as
+    the textfile collector of the node exporter expects.
+
+    Parameters
+    ----------
+    path: str
+        Textfile (e.g. ``/var/lib/node_exporter/rbstata.prom``).
+    events: list
+        Events returned by `conversion_event`.
+
+    Returns
+    -------
+    None
+    """
+    # Concurrent runs would lose each other's increments
+    with _locked(path):
+        samples = read_textfile(path)
+
+        def add(key: str, value: float) -> None:
+            samples[key] = samples.get(key, 0.0) + value
+
+        duration = "rbstata_conversion_duration_seconds"
+        buckets = {
+            bound: f"{duration}_bucket{_labels(le=bound)}"
+            for bound in [str(b) for b in DURATION_BUCKETS] + ["+Inf"]
+        }
+        for key in [*buckets.values(), f"{duration}_sum", f"{duration}_count"]:
+            add(key, 0)
+        for event in events:
+            labels = _labels(
+                engine=event["engine"] or "none", status=event["status"]
+            )
+            add(f"rbstata_files_total{labels}", 1)
+            add("rbstata_bytes_read_total", event["bytes_in"] or 0)
+            if event["status"] != "ok":
+                continue
+            add("rbstata_bytes_written_total", event["bytes_out"] or 0)
+            add("rbstata_rows_total", event["rows"] or 0)
+            for bound, key in buckets.items():
+                if (bound == "+Inf") or (event["duration_s"] <= float(bound)):
+                    add(key, 1)
+            add(f"{duration}_sum", event["duration_s"])
+            add(f"{duration}_count", 1)
+        samples["rbstata_last_run_timestamp_seconds"] = time.time()
+
+        lines = []
+        ordered = sorted(samples, key=_bound)
+        for family, (kind, description) in METRICS.items():
+            names = [family]
+            if kind == "histogram":
+                # Buckets in increasing order of their bound, then sum and count
+                names = [f"{family}_bucket", f"{family}_sum", f"{family}_count"]
+            keys = [
+                key
+                for name in names
+                for key in ordered
+                if key.split("{")[0] == name
+            ]
+            if keys:
+                lines += [f"# HELP {family} {description}"]
+                lines += [f"# TYPE {family} {kind}"]
+                lines += [f"{key} {_format(samples[key])}" for key in keys]
+
+        # Unique across the hosts sharing the directory
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
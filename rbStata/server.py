@@ -0,0 +1,191 @@
+"""Serve rbstata commands from a pool of warm worker processes."""
+import importlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr, redirect_stdout
+from typing import Any, Optional
+
+import click
+from click import ClickException
+
+from rbStata.client import is_own_socket
+
+
+def _init_worker() -> None:
+    # Ctrl-C is handled by the server, which closes the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Forked workers would inherit the server's SIGTERM handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Warm up workers that do not inherit the server's imports (spawn and
+    # forkserver start methods)
+    importlib.import_module("rbStata.cli")
+
+
+def run_request(request: dict) -> dict:
+    """Run an rbstata command in the current (worker) process.
+
+    Parameters
+    ----------
+    request: dict
+        ``argv`` (command-line arguments) and ``cwd`` (directory to run the
+        command in).
+
+    Returns
+    -------
+    Dict
+        Response sent back to the client (see `rbStata.client.forward`).
+    """
+    # Imported here as rbStata.cli imports this module
+    from rbStata.cli import rbstata
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    exit_code = 0
+    interactive = False
+    stdin = sys.stdin
+    # Prompts get no input and abort, so that the client runs them instead
+    sys.stdin = io.StringIO()
+    try:
+        os.chdir(request["cwd"])
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                result = rbstata.main(
+                    request["argv"], prog_name="rbstata", standalone_mode=False
+                )
+                exit_code = result if isinstance(result, int) else 0
+            except click.exceptions.Abort:
+                interactive = True
+            except ClickException as exc:
+                exc.show()
+                exit_code = exc.exit_code
+            except SystemExit as exc:
+                exit_code = exc.code if isinstance(exc.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+    except OSError as exc:
+        stderr.write(f"Error: {exc}\n")
+        exit_code = 1
+    finally:
+        sys.stdin = stdin
+    return dict(
+        exit_code=exit_code,
+        stdout=stdout.getvalue(),
+        stderr=stderr.getvalue(),
+        interactive=interactive,
+    )
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, workers: Optional[int] = None) -> None:
+        super().__init__(path, _Handler)
+        self.workers = workers
+        self.pool_lock = threading.Lock()
+        self.pool = ProcessPoolExecutor(workers, initializer=_init_worker)
+
+    def run(self, request: dict) -> dict:
+        with self.pool_lock:
+            pool = self.pool
+        try:
+            return pool.submit(run_request, request).result()
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OOM killer): the pool fails
+            # every pending command and is replaced for the next ones
+            with self.pool_lock:
+                if self.pool is pool:
+                    pool.shutdown(wait=False)
+                    self.pool = ProcessPoolExecutor(
+                        self.workers, initializer=_init_worker
+                    )
+            return dict(
+                exit_code=1,
+                stdout="",
+                stderr="Error: the worker running the command died.\n",
+                interactive=False,
+            )
+
+    def server_close(self) -> None:
+        super().server_close()
+        with self.pool_lock:
+            self.pool.shutdown()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        data = self.rfile.read()
+        if not data:
+            return
+        response = self.server.run(json.loads(data))  # type: ignore
+        self.wfile.write(json.dumps(response).encode())
+
+
+def _stop(signum: int, frame: Any) -> None:
+    raise KeyboardInterrupt
+
+
+def serve(
+    path: str, workers: Optional[int] = None, verbose: bool = False
+) -> None:
+    """Serve rbstata commands on a Unix socket until interrupted.
+
+    Commands sent by `rbStata.client.forward` are run by a pool of worker
+    processes that have already imported pandas, and their output and exit
+    code are sent back. Only the user running the server can connect.
+
+    Parameters
+    ----------
+    path: str
+        Path of the Unix socket.
+    workers: int
+        (Optional) Number of worker processes. Default is the number of CPUs.
+    verbose: bool
+        If True, print a message once the server is listening. Default is
+        False.
+
+    Returns
+    -------
+    None
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise ClickException("--serve needs Unix domain sockets.")
+    if os.path.lexists(path):
+        if not is_own_socket(path):
+            raise ClickException(f"{path} exists and is not your socket.")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            if sock.connect_ex(path) == 0:
+                raise ClickException(
+                    f"A server is already listening on {path}."
+                )
+        # Left behind by a server that did not shut down cleanly
+        os.remove(path)
+
+    # Only the user can connect, from the moment the socket is created
+    umask = os.umask(0o177)
+    try:
+        server = _Server(path, workers)
+    finally:
+        os.umask(umask)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _stop)
+    if verbose:
+        click.echo(
+            f"+ Serving on {path} with "
+            f"{workers or os.cpu_count()} workers (Ctrl-C to stop)."
+        )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
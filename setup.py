@@ -24,10 +24,11 @@ setup(
     author_email="lucas@lucasshen.com",
     url="https://github.com/lsys/rbStata",
     packages=find_packages(),
-    entry_points={"console_scripts": ["rbstata = rbStata.cli:rbstata"]},
+    entry_points={"console_scripts": ["rbstata = rbStata.client:main"]},
     include_package_data=True,
     python_requires=">=3.7",
     install_requires=install_requires,
+    extras_require={"cache": ["pyarrow"]},
     license="MIT",
     zip_safe=False,
     classifiers=[
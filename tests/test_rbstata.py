@@ -1,17 +1,68 @@
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
 import pytest
 from click import ClickException
 from click.testing import CliRunner
 
+from rbStata import helpers
+from rbStata.batch import (
+    CLAIM_AHEAD,
+    LOCK_SUFFIX,
+    BackgroundWriter,
+    ByteBudget,
+    claim_file,
+    find_duplicates,
+    heartbeat,
+    materialize,
+    parse_shard,
+    prefetch_files,
+    release_file,
+    renew_file,
+    shard_files,
+)
+from rbStata.cache import (
+    cache_path,
+    evict_cached,
+    file_digest,
+    load_cached,
+    store_cached,
+)
 from rbStata.cli import rbstata
+from rbStata.client import forward
+from rbStata.engines import (
+    cgroup_memory,
+    estimate_memory,
+    read_dta_header,
+    select_engine,
+)
 from rbStata.helpers import (
     add_suffix,
+    ascii_categories,
+    choose_strls,
+    compress_dta,
     convert_dta,
+    fit_str244,
     get_output_name,
     glob_dta_files,
     is_dta_file,
     normalize_dta_filename,
     normalize_filename,
+    object_strings,
+    read_dta_chunked,
+    share_strings,
+    storage_widths,
 )
+from rbStata.metrics import read_textfile, update_textfile
 
 DATAPATH = "assets/datasets"
 
@@ -116,6 +167,223 @@ def test_convert_dta():
         )
 
 
+def test_compress_dta():
+    df = pd.DataFrame(
+        {
+            "byte": [1.0, 100.0],
+            "int": np.array([-200, 300], dtype="int64"),
+            "float": [0.5, np.nan],
+            "double": [0.1, 0.2],
+            "missing": [1.0, np.nan],
+            "str": ["a", "abc"],
+        }
+    )
+    result, saved = compress_dta(df, {**storage_widths(df), "str": 244})
+    assert result["byte"].dtype == np.int8
+    assert result["int"].dtype == np.int16
+    assert result["float"].dtype == np.float32
+    assert result["double"].dtype == np.float64
+    assert result["missing"].dtype == np.float32
+    # (8 - 1) + (8 - 2) + (8 - 4) + (8 - 4) + (244 - 3) bytes per observation
+    assert saved == 2 * 262
+    pd.testing.assert_frame_equal(result, df, check_dtype=False)
+
+    report = convert_dta(
+        f"{DATAPATH}/auto.dta",
+        f"{DATAPATH}/test-output.dta",
+        target_version=13,
+        compress=True,
+    )
+    assert report["bytes_saved"] > 0
+    expected = pd.read_stata(f"{DATAPATH}/auto.dta")
+    result = pd.read_stata(f"{DATAPATH}/test-output.dta")
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_strls(tmp_path):
+    text = "Zürich " * 100
+    df = pd.DataFrame(
+        {
+            "text": [text, "short", None, text] * 25,
+            "repeated": ["x" * 300, "y" * 300] * 50,
+            "unique": [str(i) * 10 for i in range(100)],
+        }
+    )
+    assert choose_strls(df, 117) == []
+    assert choose_strls(df, 117, save_space=True) == ["text", "repeated"]
+    assert choose_strls(df.assign(long="x" * 2046), 117) == ["long"]
+
+    shared = share_strings(df["repeated"])
+    assert shared[0] is shared[2]
+    assert shared.tolist() == df["repeated"].tolist()
+    encoded = share_strings(
+        pd.Series(["Zürich", "Łódź", None]), None, "latin-1"
+    )
+    assert encoded.tolist() == ["Zürich".encode("latin-1"), b"Lodz", None]
+
+    labels = {"text": "Label"}
+    result, labels, truncated = fit_str244(df.copy(), labels)
+    assert truncated == {"text": 50, "repeated": 100}
+    assert result["text"][0] == text[:244]
+    assert result["text"][1] == "short"
+    assert pd.isna(result["text"][2])
+
+    result, labels, truncated = fit_str244(df.copy(), labels, split=True)
+    assert truncated == {}
+    assert list(result.columns[:4]) == ["text", "text_2", "text_3", "repeated"]
+    assert labels["text_3"] == "Label (3)"
+    assert "".join(result.loc[0, ["text", "text_2", "text_3"]]) == text
+
+    # Only strings that latin-1 cannot encode are transliterated
+    short = pd.DataFrame({"s": ["Zürich", "Genève", "Łódź"]})
+    assert fit_str244(short, {})[0]["s"].tolist() == [
+        "Zürich",
+        "Genève",
+        "Lodz",
+    ]
+
+    # Names of split variables do not clash with existing ones
+    taken = pd.DataFrame(
+        {"s": ["x" * 300], "s_2": ["y"], "v" * 32: ["z" * 300]}
+    )
+    result, labels, _ = fit_str244(taken, {}, split=True)
+    assert list(result.columns) == [
+        "s",
+        "s_2_1",
+        "s_2",
+        "v" * 32,
+        "v" * 30 + "_2",
+    ]
+    assert result["s_2"][0] == "y"
+
+    src = str(tmp_path / "strl.dta")
+    out = str(tmp_path / "out.dta")
+    df.to_stata(src, version=118, write_index=False)
+    convert_dta(src, out, target_version=14)
+    pd.testing.assert_frame_equal(
+        pd.read_stata(out), pd.read_stata(src), check_dtype=False
+    )
+    # Stata 13 reads latin-1, including in strLs
+    for compact_strls in [False, True]:
+        convert_dta(src, out, 13, compact_strls=compact_strls)
+        result = pd.read_stata(out)
+        assert result["text"][0] == text
+        assert result["repeated"].tolist() == df["repeated"].tolist()
+        with pd.read_stata(out, iterator=True) as reader:
+            reader.variable_labels()  # reads the header
+            strls = [typ == "Q" for typ in reader._typlist]
+        assert any(strls) == compact_strls
+    # Strings that latin-1 can encode are kept, whatever the other columns
+    mixed = str(tmp_path / "mixed.dta")
+    pd.DataFrame({"a": ["Zürich"], "b": ["Łódź"]}).to_stata(
+        mixed, version=118, write_index=False
+    )
+    convert_dta(mixed, out, target_version=13)
+    assert pd.read_stata(out).loc[0].tolist() == ["Zürich", "Lodz"]
+
+    # So are value labels
+    labelled = str(tmp_path / "labelled.dta")
+    cities = pd.Categorical(["Łódź", "Kraków", "Łódź"])
+    pd.DataFrame({"city": cities}).to_stata(
+        labelled, version=118, write_index=False
+    )
+    for target in [13, 12]:
+        convert_dta(labelled, out, target_version=target)
+        result = pd.read_stata(out)["city"]
+        assert result.tolist() == ["Lodz", "Kraków", "Lodz"]
+    merged = pd.DataFrame({"c": pd.Categorical(["Łódź", "Lodz", "Kraków"])})
+    assert ascii_categories(merged)["c"].tolist() == ["Lodz", "Lodz", "Krakow"]
+
+    report = convert_dta(src, out, target_version=12)
+    assert report["truncated"] == {"text": 50, "repeated": 100}
+    assert pd.read_stata(out)["text"].str.len().max() == 244
+
+
+def test_engines(tmp_path):
+    header = read_dta_header(f"{DATAPATH}/census.dta")
+    assert (header["release"], header["nobs"], header["nvar"]) == (117, 50, 13)
+    assert header["nstr"] == 2
+    assert read_dta_header(__file__) is None
+
+    old = str(tmp_path / "old.dta")
+    pd.read_stata(f"{DATAPATH}/auto.dta").to_stata(
+        old, version=114, write_index=False
+    )
+    header = read_dta_header(old)
+    assert (header["release"], header["nobs"], header["nvar"]) == (114, 74, 12)
+    assert (len(header["widths"]), header["nstr"]) == (12, 1)
+
+    # Fastest engine that fits, or the leanest one if none fits
+    assert select_engine(old, 117)[0] == "binary"
+    assert select_engine(old, 117, transform=True)[0] == "pandas"
+    assert select_engine(f"{DATAPATH}/auto.dta", 117)[0] == "pandas"
+    needed = estimate_memory(read_dta_header(f"{DATAPATH}/auto.dta"), "pandas")
+    engine, decision = select_engine(
+        f"{DATAPATH}/auto.dta", 117, memory_limit=needed - 1
+    )
+    assert engine == "streaming"
+    assert decision["estimates"]["pandas"] == needed
+    assert decision["fits"]
+    engine, decision = select_engine(f"{DATAPATH}/auto.dta", 117, 1)
+    assert (engine, decision["fits"]) == ("streaming", False)
+
+    # Streaming reads match reading at once (including value labels)
+    with pd.read_stata(f"{DATAPATH}/nlsw88.dta", iterator=True) as reader:
+        result = read_dta_chunked(reader, chunksize=100)
+    expected = pd.read_stata(f"{DATAPATH}/nlsw88.dta")
+    pd.testing.assert_frame_equal(result, expected)
+
+    out = str(tmp_path / "out.dta")
+    convert_dta(f"{DATAPATH}/auto.dta", out, 13, engine="streaming")
+    pd.testing.assert_frame_equal(
+        pd.read_stata(out), pd.read_stata(f"{DATAPATH}/auto.dta")
+    )
+    convert_dta(old, out, 13, engine="binary")
+    with open(old, "rb") as f, open(out, "rb") as g:
+        assert f.read() == g.read()
+    with pytest.raises(ClickException):
+        convert_dta(f"{DATAPATH}/auto.dta", out, 13, engine="binary")
+    with pytest.raises(ClickException):
+        convert_dta(old, out, 13, compress=True, engine="binary")
+
+    # Warn (even without --verbose) when no engine fits
+    shutil.copy(f"{DATAPATH}/auto.dta", tmp_path / "auto.dta")
+    args = [str(tmp_path / "auto.dta"), "-t", "13"]
+    result = CliRunner().invoke(rbstata, args + ["--memory-limit", "0"])
+    assert result.exit_code == 0
+    assert "no engine fits" in result.output
+    assert "+ Warning:" in result.output
+    result = CliRunner().invoke(rbstata, args + ["-e", "binary", "-c"])
+    assert result.exit_code != 0
+    assert "cannot --compress" in result.output
+    result = CliRunner().invoke(
+        rbstata, args + ["-e", "binary", "--compact-strls"]
+    )
+    assert result.exit_code != 0
+    assert "cannot --compact-strls" in result.output
+    with pytest.raises(ClickException):
+        convert_dta(old, out, 13, compact_strls=True, engine="binary")
+    # Compacting strLs is a transformation, so the file is not copied as is
+    args = [str(tmp_path / "auto.dta"), "-t", "15", "-v", "--compact-strls"]
+    result = CliRunner().invoke(rbstata, args + ["-o", out])
+    assert result.exit_code == 0
+    assert "auto.dta: pandas" in result.output
+
+    # The cgroup limit caps the available memory
+    cgroup = tmp_path / "cgroup"
+    cgroup.mkdir()
+    assert cgroup_memory(str(cgroup)) is None
+    (cgroup / "memory.max").write_text("max\n")
+    assert cgroup_memory(str(cgroup)) is None
+    (cgroup / "memory.max").write_text("1000\n")
+    (cgroup / "memory.current").write_text("400\n")
+    assert cgroup_memory(str(cgroup)) == 600
+    (cgroup / "memory.max").unlink()
+    (cgroup / "memory").mkdir()
+    (cgroup / "memory" / "memory.limit_in_bytes").write_text(f"{2**63 - 4096}")
+    assert cgroup_memory(str(cgroup)) is None
+
+
 def test_rbstata():
     runner = CliRunner()
 
@@ -247,3 +515,473 @@ def test_rbstata():
     assert "dta files entered:" in result.output
     assert "Valid dta files to be converted:" in result.output
     assert "Conversions complete." in result.output
+
+
+def test_shard_files():
+    files = [f"dir{i}/file{i}.dta" for i in range(100)]
+    shards = [shard_files(files, i, 4) for i in range(4)]
+    assert sorted(sum(shards, [])) == sorted(files)
+    assert all(len(shard) > 0 for shard in shards)
+    assert shard_files(files, 1, 4) == shards[1]
+
+    assert parse_shard("3/4") == (3, 4)
+    for invalid in ["4/4", "-1/4", "1", "a/b", "0/0"]:
+        with pytest.raises(ClickException):
+            parse_shard(invalid)
+
+
+def _claim_all(files, queue):
+    for file in files:
+        if claim_file(file):
+            queue.put(file)
+            release_file(file)
+
+
+def _take_over_all(files, queue):
+    for file in files:
+        if claim_file(file, lease=60):
+            queue.put(file)
+
+
+def test_claim_file(tmp_path):
+    files = [str(tmp_path / f"file{i}.dta") for i in range(20)]
+    for file in files:
+        open(file, "w").close()
+
+    # Several processes pulling from the same file set
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    procs = [
+        ctx.Process(target=_claim_all, args=(files, queue)) for _ in range(4)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    claimed = [queue.get() for _ in range(queue.qsize())]
+    assert sorted(claimed) == sorted(files)
+
+    # Finished claims are never taken again
+    assert not claim_file(files[0], lease=0)
+
+    # Several processes taking over the same expired claims
+    stale = [str(tmp_path / f"stale{i}.dta") for i in range(20)]
+    old = time.time() - 3600
+    for file in stale:
+        with open(f"{file}{LOCK_SUFFIX}", "w") as f:
+            json.dump(dict(token=file, state="running"), f)
+        os.utime(f"{file}{LOCK_SUFFIX}", (old, old))
+    procs = [
+        ctx.Process(target=_take_over_all, args=(stale, queue))
+        for _ in range(4)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    claimed = [queue.get() for _ in range(queue.qsize())]
+    assert len(claimed) == len(set(claimed))
+    assert not any(os.path.exists(f"{f}{LOCK_SUFFIX}.break") for f in stale)
+
+    # A lock being broken by another process is left to it, unless the
+    # breaking process died
+    lock = f"{stale[0]}{LOCK_SUFFIX}"
+    os.utime(lock, (old, old))
+    open(f"{lock}.break", "w").close()
+    assert not claim_file(stale[0], lease=60)
+    os.utime(f"{lock}.break", (old, old))
+    assert claim_file(stale[0], lease=60)
+
+    # Failed claims are released for retry
+    new = str(tmp_path / "new.dta")
+    assert claim_file(new)
+    assert not claim_file(new)
+    release_file(new, done=False)
+    assert claim_file(new)
+
+    # Expired claims are taken over
+    old = time.time() - 3600
+    os.utime(f"{new}{LOCK_SUFFIX}", (old, old))
+    assert claim_file(new, lease=60)
+
+    # Renewed claims do not expire
+    os.utime(f"{new}{LOCK_SUFFIX}", (old, old))
+    assert renew_file(new)
+    assert not claim_file(new, lease=60)
+    with open(f"{new}{LOCK_SUFFIX}", "w") as f:
+        json.dump(dict(host="elsewhere", pid=1, state="running"), f)
+    assert not renew_file(new)
+    assert not renew_file(files[0])
+
+    # Claims taken over by another process are not released by the first
+    job = str(tmp_path / "job.dta")
+    assert claim_file(job, job="13")
+    with open(f"{job}{LOCK_SUFFIX}", "w") as f:
+        json.dump(dict(token="other", state="running"), f)
+    release_file(job)
+    release_file(job, done=False)
+    assert json.load(open(f"{job}{LOCK_SUFFIX}")) == dict(
+        token="other", state="running"
+    )
+    os.remove(f"{job}{LOCK_SUFFIX}")
+
+    # Finished claims are taken again by another job only
+    assert claim_file(job, job="13")
+    release_file(job)
+    assert not claim_file(job, job="13")
+    assert claim_file(job, job="12")
+
+    # Claims are renewed while converting
+    os.utime(f"{job}{LOCK_SUFFIX}", (old, old))
+    with heartbeat(0.3):
+        time.sleep(0.5)
+    assert os.stat(f"{job}{LOCK_SUFFIX}").st_mtime > old + 3000
+    release_file(job)
+
+    # Another target version converts the files again
+    shutil.copy(f"{DATAPATH}/auto.dta", tmp_path / "auto.dta")
+    shutil.copy(f"{DATAPATH}/census.dta", tmp_path / "census.dta")
+    args = [str(tmp_path / "auto.dta"), str(tmp_path / "census.dta")]
+    out = str(tmp_path / "auto-rbstata.dta")
+    for target, release, skipped in [
+        (13, 117, False),
+        (13, 117, True),
+        (12, 114, False),
+    ]:
+        result = CliRunner().invoke(
+            rbstata, args + ["-t", str(target), "--work-steal", "-v"]
+        )
+        assert result.exit_code == 0
+        assert ("claimed elsewhere" in result.output) == skipped
+        assert read_dta_header(out)["release"] == release
+
+
+def test_find_duplicates(tmp_path, monkeypatch):
+    for name in ["a", "b", "c"]:
+        (tmp_path / name).mkdir()
+        shutil.copy(f"{DATAPATH}/auto.dta", tmp_path / name / "auto.dta")
+    shutil.copy(f"{DATAPATH}/census.dta", tmp_path / "census.dta")
+    files = [str(p) for p in sorted(tmp_path.glob("**/*.dta"))]
+    files.append(str(tmp_path / "missing.dta"))
+
+    duplicates = find_duplicates(files)
+    assert duplicates == {files[0]: files[1:3]}
+
+    for method in ["reflink", "hardlink", "copy"]:
+        dst = str(tmp_path / f"{method}.dta")
+        assert materialize(files[0], dst, method) in (method, "copy")
+        with open(files[0], "rb") as src, open(dst, "rb") as out:
+            assert src.read() == out.read()
+
+    source = os.path.abspath(f"{DATAPATH}/auto.dta")
+    runner = CliRunner()
+    (tmp_path / "cli").mkdir()
+    monkeypatch.chdir(tmp_path / "cli")
+    for name in ["x", "y"]:
+        os.mkdir(name)
+        shutil.copy(source, os.path.join(name, "auto.dta"))
+    result = runner.invoke(
+        rbstata,
+        ["--all", "-r", "-t", "13", "--dedup", "hardlink", "--verbose"],
+    )
+    assert result.exit_code == 0
+    assert "1 conversions avoided." in result.output
+    assert os.path.samefile("x/auto-rbstata.dta", "y/auto-rbstata.dta")
+
+
+def test_pipeline(tmp_path):
+    files = [f"{DATAPATH}/{name}.dta" for name in ["auto", "census", "nlsw88"]]
+    files.insert(1, "dummy.dta")
+
+    # Read-ahead is bounded by the budget (files larger than it go alone)
+    budget = ByteBudget(1024)
+    for file, data in prefetch_files(files, budget):
+        assert 0 < budget.used <= budget.limit or data is None
+        if data is not None:
+            with open(file, "rb") as f:
+                assert data == f.read()
+    assert budget.used == 0
+
+    # Unclaimed files are not read
+    prefetched = prefetch_files(files, budget, claim=lambda f: "auto" in f)
+    assert [data is not None for _, data in prefetched] == [
+        True,
+        False,
+        False,
+        False,
+    ]
+
+    # Claims made ahead are released when the iterator is closed early
+    copies = [str(tmp_path / f"copy{i}.dta") for i in range(CLAIM_AHEAD + 2)]
+    for copy in copies:
+        shutil.copy(files[0], copy)
+    prefetched = prefetch_files(
+        copies,
+        ByteBudget(2**30),
+        claim_file,
+        partial(release_file, done=False),
+    )
+    first, _ = next(prefetched)
+    time.sleep(0.2)
+    # The first file and at most CLAIM_AHEAD more are claimed
+    locks = [os.path.exists(f"{file}{LOCK_SUFFIX}") for file in copies]
+    assert locks == [True] * (1 + CLAIM_AHEAD) + [False]
+    prefetched.close()
+    locks = [os.path.exists(f"{file}{LOCK_SUFFIX}") for file in copies]
+    assert locks == [file == first for file in copies]
+    os.remove(f"{first}{LOCK_SUFFIX}")
+
+    written = []
+    writer = BackgroundWriter(ByteBudget(1024))
+    for i in range(3):
+        out = str(tmp_path / f"out{i}")
+        writer.submit(
+            out, b"x" * 2000, callback=lambda o=out: written.append(o)
+        )
+    writer.close()
+    assert len(written) == 3
+    assert (tmp_path / "out2").read_bytes() == b"x" * 2000
+
+    writer = BackgroundWriter(ByteBudget(1024))
+    writer.submit(str(tmp_path / "missing" / "out"), b"x")
+    with pytest.raises(OSError):
+        writer.close()
+
+    runner = CliRunner()
+    outputs = []
+    for file in files[2:]:
+        shutil.copy(file, tmp_path)
+        outputs.append(str(tmp_path / os.path.basename(file)))
+    result = runner.invoke(
+        rbstata, outputs + ["-t", "13", "--pipeline", "--buffer-size", "1"]
+    )
+    assert result.exit_code == 0
+    for file in outputs:
+        expected = pd.read_stata(file)
+        result = pd.read_stata(file.replace(".dta", "-rbstata.dta"))
+        pd.testing.assert_frame_equal(result, expected)
+
+
+def test_wide(tmp_path, monkeypatch):
+    # Force several blocks of string columns
+    monkeypatch.setattr(helpers, "BLOCK_CELLS", 100)
+    n = 20
+    columns = {}
+    for i in range(300):
+        if i % 3 == 0:
+            columns[f"s{i}"] = [f"Łódź {i}", None, "x" * (i + 1)] * n
+        else:
+            columns[f"v{i}"] = np.arange(3 * n, dtype=np.int16) + i
+    df = pd.DataFrame(columns)
+    converted = object_strings(df)
+    assert converted.columns.tolist() == df.columns.tolist()
+    assert (converted.dtypes[::3] == object).all()
+    assert converted.iloc[1, 0] is None
+
+    src = str(tmp_path / "wide.dta")
+    out = str(tmp_path / "out.dta")
+    labels = {col: "Libellé " * 10 for col in df.columns}
+    df.to_stata(src, version=118, write_index=False, variable_labels=labels)
+    convert_dta(src, out, target_version=13)
+    result = pd.read_stata(out)
+    pd.testing.assert_frame_equal(
+        result.iloc[:, 1::3], df.iloc[:, 1::3], check_dtype=False
+    )
+    assert result["s3"][0] == "Lodz 3"
+    assert result["s297"][2] == "x" * 298
+    with pd.read_stata(out, iterator=True) as reader:
+        assert reader.variable_labels()["v1"] == labels["v1"]
+
+    report = convert_dta(src, out, target_version=12)
+    assert report["truncated"] == {f"s{i}": n for i in range(246, 300, 3)}
+
+
+def _update_metrics(path, runs):
+    event = dict(
+        engine="pandas",
+        status="ok",
+        bytes_in=10,
+        bytes_out=10,
+        rows=1,
+        duration_s=0.1,
+    )
+    for _ in range(runs):
+        update_textfile(path, [event])
+
+
+def test_metrics(tmp_path, monkeypatch):
+    for name in ["auto", "census"]:
+        shutil.copy(f"{DATAPATH}/{name}.dta", tmp_path / f"{name}.dta")
+    monkeypatch.chdir(tmp_path)
+    runner = CliRunner()
+    args = ["auto.dta", "census.dta", "-t", "13", "--log-format", "json"]
+    args += ["--metrics-file", "rbstata.prom"]
+    for pipeline in ([], ["--pipeline"]):
+        result = runner.invoke(rbstata, args + pipeline)
+        assert result.exit_code == 0
+        events = [json.loads(line) for line in result.stderr.splitlines()]
+        assert sorted(e["path"] for e in events) == ["auto.dta", "census.dta"]
+        auto = [e for e in events if e["path"] == "auto.dta"][0]
+        assert auto["status"] == "ok" and auto["error"] is None
+        assert auto["output"] == "auto-rbstata.dta"
+        assert (auto["source_format"], auto["target_format"]) == (118, 117)
+        assert auto["bytes_out"] == os.path.getsize("auto-rbstata.dta")
+        assert (auto["rows"], auto["engine"]) == (74, "pandas")
+
+    samples = read_textfile("rbstata.prom")
+    duration = "rbstata_conversion_duration_seconds"
+    assert samples[f"{duration}_count"] == 4
+    assert samples[f'{duration}_bucket{{le="+Inf"}}'] == 4
+    assert samples['rbstata_files_total{engine="pandas",status="ok"}'] == 2
+    assert samples["rbstata_rows_total"] == 2 * (74 + 50)
+
+    with open("bad.dta", "w") as f:
+        f.write("not a dta file")
+    result = runner.invoke(rbstata, ["bad.dta", "-t", "13"] + args[4:])
+    assert result.exit_code != 0
+    (event,) = [json.loads(line) for line in result.stderr.splitlines()[:1]]
+    assert (event["path"], event["status"]) == ("bad.dta", "error")
+    assert event["error"]["type"] and event["error"]["message"]
+    samples = read_textfile("rbstata.prom")
+    assert samples['rbstata_files_total{engine="pandas",status="error"}'] == 1
+
+    # Concurrent runs do not lose each other's updates
+    path = str(tmp_path / "concurrent.prom")
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=_update_metrics, args=(path, 25)) for _ in range(4)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    samples = read_textfile(path)
+    assert samples['rbstata_files_total{engine="pandas",status="ok"}'] == 100
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+
+    # With --overwrite, the event still describes the source
+    size = os.path.getsize("auto.dta")
+    result = runner.invoke(rbstata, ["auto.dta", "-t", "13", "-w"] + args[4:6])
+    assert result.exit_code == 0
+    (event,) = [json.loads(line) for line in result.stderr.splitlines()]
+    assert (event["bytes_in"], event["source_format"]) == (size, 118)
+    assert (event["bytes_out"], event["target_format"]) == (
+        os.path.getsize("auto.dta"),
+        117,
+    )
+
+
+def test_cache(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    cache = str(tmp_path / "cache")
+    src = f"{DATAPATH}/nlsw88.dta"
+    with open(src, "rb") as f:
+        key = file_digest(f)
+    assert key == file_digest(src)
+
+    outputs = []
+    for expected in ["miss", "hit"]:
+        out = str(tmp_path / f"{expected}.dta")
+        report = convert_dta(src, out, 13, cache_dir=cache)
+        assert report["cache"] == expected
+        outputs.append(out)
+    pd.testing.assert_frame_equal(*[pd.read_stata(out) for out in outputs])
+    with pd.read_stata(outputs[0], iterator=True) as miss:
+        with pd.read_stata(outputs[1], iterator=True) as hit:
+            assert miss.variable_labels() == hit.variable_labels()
+            assert miss.value_labels() == hit.value_labels()
+            assert miss.data_label == hit.data_label
+
+    df, meta = load_cached(cache, key)
+    assert isinstance(df["race"].dtype, pd.CategoricalDtype)
+    assert meta["value_labels"]["racelbl"][1] == "White"
+
+    # Numeric columns are not copied out of the mapped file
+    numeric = str(tmp_path / "numeric.dta")
+    x = np.arange(10**6, dtype=np.float64)
+    pd.DataFrame({"x": x, "y": x}).to_stata(numeric, write_index=False)
+    convert_dta(numeric, outputs[0], 13, cache_dir=cache)
+    allocated = pa.total_allocated_bytes()
+    df, _ = load_cached(cache, file_digest(numeric))
+    assert pa.total_allocated_bytes() - allocated < x.nbytes
+    del df
+    os.remove(cache_path(cache, file_digest(numeric)))
+
+    # Least recently used files are evicted first
+    for name in ["auto", "census"]:
+        convert_dta(f"{DATAPATH}/{name}.dta", outputs[0], 13, cache_dir=cache)
+        time.sleep(0.01)
+    load_cached(cache, key)
+    sizes = {p.name: p.stat().st_size for p in (tmp_path / "cache").iterdir()}
+    assert evict_cached(cache, sum(sizes.values()) - 1) == 1
+    remaining = {p.name for p in (tmp_path / "cache").iterdir()}
+    assert remaining == set(sizes) - {
+        file_digest(f"{DATAPATH}/auto.dta") + ".arrow"
+    }
+
+    # Files larger than the cache are not stored, and evict nothing
+    df = pd.read_stata(numeric)
+    assert not store_cached(cache, "large", df, {}, max(sizes.values()))
+    assert {p.name for p in (tmp_path / "cache").iterdir()} == remaining
+    report = convert_dta(numeric, outputs[0], 13, cache_dir=cache, cache_size=1)
+    assert report["cache"] == "miss"
+    assert {p.name for p in (tmp_path / "cache").iterdir()} == remaining
+
+
+def test_serve(tmp_path):
+    path = str(tmp_path / "rbstata.sock")
+    assert forward(["auto.dta"], path) is None
+    # Only sockets owned by the user are trusted
+    with open(path, "w"):
+        pass
+    assert forward(["auto.dta"], path) is None
+    os.remove(path)
+    command = "from rbStata.cli import rbstata; rbstata()"
+    server = subprocess.Popen(
+        [sys.executable, "-c", command, "--serve", "--socket", path],
+        env=dict(os.environ, PYTHONPATH=os.getcwd()),
+    )
+    try:
+        for _ in range(300):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        shutil.copy(f"{DATAPATH}/auto.dta", tmp_path / "auto.dta")
+        cwd = os.getcwd()
+        os.chdir(tmp_path)
+        try:
+            response = forward(["auto.dta", "-t", "13", "-v"], path)
+            assert response["exit_code"] == 0
+            assert not response["interactive"]
+            assert "auto-rbstata.dta" in response["stdout"]
+            assert read_dta_header("auto-rbstata.dta")["release"] == 117
+
+            response = forward(["missing.dta", "-t", "13"], path)
+            assert response["exit_code"] != 0
+            assert "missing.dta" in response["stderr"]
+
+            # Commands that prompt are left to the client
+            assert forward([], path)["interactive"]
+
+            # Commands fail, rather than hang, if their worker dies, and the
+            # workers are replaced
+            children = f"/proc/{server.pid}/task/{server.pid}/children"
+            if os.path.exists(children):
+                with open(children) as f:
+                    workers = [int(pid) for pid in f.read().split()]
+                assert workers
+                for pid in workers:
+                    os.kill(pid, signal.SIGKILL)
+                time.sleep(1)
+                response = forward(["auto.dta", "-t", "12"], path)
+                assert response["exit_code"] == 1
+                assert "worker" in response["stderr"]
+                response = forward(["auto.dta", "-t", "12"], path)
+                assert response["exit_code"] == 0
+        finally:
+            os.chdir(cwd)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    assert not os.path.exists(path)